@@ -1,28 +1,137 @@
+import math
 import os, pdb
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify, abort
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows
+import assets
+import compression
+import conditional
+import feeds
+import fragments
+import hashing
+from conditional import messages_stamp, not_modified
+import instrumentation
+import plans
+import search
+import sessions
+import throttle
+from membership import Membership
+from pagination import IdPage, paginate, request_cursor
+from search import (USERS_PER_PAGE, autocomplete_index, directory_page,
+                    search_users, user_added, user_removed)
+from streaming import render_list
 
 CURR_USER_KEY = "curr_user"
+USER_SNAPSHOT_KEY = "curr_user_snapshot"
+
+
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask `g` that only loads `g.user` the first time it is read."""
+
+    def __getattr__(self, name):
+        if name == 'user':
+            self.user = load_current_user()
+            return self.user
+
+        raise AttributeError(name)
+
 
 app = Flask(__name__)
+app.app_ctx_globals_class = WarblerGlobals
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
+DEFAULT_DATABASE_URL = 'postgres:///warbler'
 app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+    os.environ.get('DATABASE_URL', DEFAULT_DATABASE_URL))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Authors with more followers than this are merged into home feeds at read
+# time instead of being pushed into every follower's timeline.
+app.config['FEED_FANOUT_THRESHOLD'] = int(
+    os.environ.get('FEED_FANOUT_THRESHOLD', 10000))
+
+# Sessions, including a snapshot of the logged-in user's row and follow/
+# like id sets, are kept server-side: 'memory' (this process) or
+# 'unix:///path/to.sock', a store shared through `flask session-store`
+# (see sessions.py). The write paths below retire outdated snapshots.
+app.config['SESSION_STORE'] = os.environ.get('SESSION_STORE', 'memory')
+app.config['SESSION_STORE_SIZE'] = 100000
+
+# How message lists load their authors: 'selectin', 'joined' or 'lean'
+# (see feeds.with_authors).
+app.config['FEED_AUTHOR_LOADING'] = os.environ.get('FEED_AUTHOR_LOADING',
+                                                   'selectin')
+
+# Rendered message items and user cards are cached in-process (see
+# fragments.py); other processes' profile edits show up after the TTL.
+app.config['FRAGMENT_CACHE_SIZE'] = 50000
+app.config['FRAGMENT_CACHE_TTL'] = 300
+
+# Text responses at least this big are gzip/brotli-compressed on the way
+# out (see compression.py); compressed copies of responses with an ETag
+# are cached.
+app.config['COMPRESSION_MIN_SIZE'] = 500
+app.config['COMPRESSION_GZIP_LEVEL'] = 6
+app.config['COMPRESSION_BROTLI_LEVEL'] = 4
+app.config['COMPRESSION_CACHE_SIZE'] = 512
+
+# Stream the followers, following and likes pages as they render (see
+# streaming.py).
+app.config['STREAM_TEMPLATES'] = bool(os.environ.get('STREAM_TEMPLATES'))
+
+# bcrypt cost of new password hashes; older hashes are upgraded on login.
+# Hashing runs in HASH_WORKERS processes (0: in the request thread), with
+# at most HASH_MAX_PENDING jobs waiting before logins get a 503 (see
+# hashing.py).
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['HASH_WORKERS'] = int(os.environ.get('HASH_WORKERS',
+                                                os.cpu_count() or 1))
+app.config['HASH_MAX_PENDING'] = None
+app.config['HASH_QUEUE_TIMEOUT'] = 2.0
+
+# Login attempts allowed per username and per client address, as
+# (attempts, seconds) token buckets, and password checks allowed at once;
+# excess attempts are refused before any hashing (see throttle.py). The
+# buckets are kept in the session store unless THROTTLE_BACKEND is set.
+# TRUSTED_PROXIES: reverse proxies in front of the app whose
+# X-Forwarded-For gives the client address.
+app.config['LOGIN_LIMIT_PER_USERNAME'] = (5, 60)
+app.config['LOGIN_LIMIT_PER_ADDRESS'] = (20, 60)
+app.config['LOGIN_MAX_CONCURRENT'] = 4
+app.config['THROTTLE_BACKEND'] = None
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+# Build the username autocomplete index when the app starts, so no request
+# waits on it (see search.py). Off where the tables may not exist yet.
+app.config['AUTOCOMPLETE_AT_STARTUP'] = os.environ.get(
+    'AUTOCOMPLETE_AT_STARTUP', '1') != '0'
+
+# Serve in-process request/SQL metrics as JSON at /_metrics.
+app.config['EXPOSE_METRICS'] = bool(os.environ.get('EXPOSE_METRICS'))
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+instrumentation.init_app(app)
+fragments.init_app(app)
+conditional.init_app(app)
+assets.init_app(app)
+compression.init_app(app)
+hashing.init_app(app)
+sessions.init_app(app)
+throttle.init_app(app)
+search.init_app(app)
 
 
 ##############################################################################
@@ -31,18 +140,83 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    Only the id is read here; g.user itself is loaded on first use (see
+    WarblerGlobals), from the session's snapshot of the user when that is
+    still current.
+    """
 
-    else:
-        g.user = None
+    g.user_id = session.get(CURR_USER_KEY)
+    g.user_snapshot = {}
+
+    if g.user_id is not None:
+        g.user_version = sessions.user_version(g.user_id)
+        snapshot = session.get(USER_SNAPSHOT_KEY)
+
+        if snapshot and snapshot['version'] == g.user_version:
+            g.user_snapshot = snapshot
+
+    following_ids = g.user_snapshot.get('following_ids')
+    liked_ids = g.user_snapshot.get('liked_ids')
+
+    g.membership = Membership(
+        g.user_id,
+        None if following_ids is None else set(following_ids),
+        None if liked_ids is None else set(liked_ids))
+
+
+def load_current_user():
+    """Fetch the logged-in user, from the session snapshot if possible."""
+
+    if g.get('user_id') is None:
+        return None
+
+    if 'columns' in g.user_snapshot:
+        return User.from_snapshot(g.user_snapshot['columns'])
+
+    user = User.query.get(g.user_id)
+    if user:
+        g.loaded_user_columns = user.snapshot()
+
+    return user
+
+
+def invalidate_user(user_id):
+    """Retire `user_id`'s snapshots (row and follow/like sets) after a change."""
+
+    sessions.user_changed(user_id)
+
+    if user_id == g.get('user_id'):
+        g.user_invalidated = True
+
+
+@app.after_request
+def save_user_snapshot(resp):
+    """Keep the user row and id sets loaded by this request for the next."""
+
+    if g.get('user_id') is None or g.get('user_invalidated'):
+        return resp
+
+    loaded = {name: sorted(ids)
+              for name, ids in g.membership.loaded().items()
+              if name not in g.user_snapshot}
+    if 'loaded_user_columns' in g:
+        loaded['columns'] = g.loaded_user_columns
+
+    if loaded:
+        session[USER_SNAPSHOT_KEY] = {**g.user_snapshot, **loaded,
+                                      'version': g.user_version}
+
+    return resp
 
 
 def do_login(user):
     """Log in user."""
 
+    # a new session id, so one set before login can't be reused
+    session.regenerate()
+    session.pop(USER_SNAPSHOT_KEY, None)
     session[CURR_USER_KEY] = user.id
 
 def do_logout():
@@ -51,6 +225,8 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(USER_SNAPSHOT_KEY, None)
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -75,6 +251,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            user_added(user.id, user.username)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -95,10 +272,25 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            with throttle.login_throttle.attempt(form.username.data,
+                                                 request.remote_addr):
+                user = User.authenticate(form.username.data,
+                                         form.password.data)
+
+        except throttle.Throttled as throttled:
+            flash("Too many login attempts. Please try again later.",
+                  'danger')
+            return (render_template('users/login.html', form=form),
+                    throttled.status,
+                    {'Retry-After': str(math.ceil(throttled.retry_after))})
 
         if user:
+            if user in db.session.dirty:
+                # its password hash was upgraded to the current cost
+                db.session.commit()
+                invalidate_user(user.id)
+
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -124,17 +316,38 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username; the
+    ranked results are paged with 'page'. Without 'q', the directory is
+    paged by id with 'after'.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users, next_after = directory_page(request.args.get('after', type=int))
+        next_url = next_after and url_for('list_users', after=next_after)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        users, has_next = search_users(search, page)
+        next_url = has_next and url_for('list_users', q=search, page=page + 1)
+
+    return render_template('users/index.html', users=users, next_url=next_url)
+
+
+@app.route('/api/users/autocomplete')
+def autocomplete_users():
+    """JSON list of users whose username starts with the 'q' param.
 
-    return render_template('users/index.html', users=users)
+    Served from the in-memory prefix index; never touches the database.
+    Takes an optional 'limit' (default 10, at most 50).
+    """
+
+    prefix = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    matches = autocomplete_index.complete(prefix, limit) if prefix else []
+
+    return jsonify(users=[{'id': user_id, 'username': username}
+                          for user_id, username in matches])
 
 
 @app.route('/users/<int:user_id>')
@@ -145,38 +358,55 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = paginate(feeds.with_authors(feeds.author_messages(user_id)),
+                    Message.timestamp, Message.id, request_cursor(),
+                    fetch=feeds.fetch_messages)
+
+    cached = not_modified(user.snapshot(),
+                          messages_stamp(page.items, page.next_cursor))
+    if cached:
+        return cached
+
+    return render_template('users/show.html', user=user,
+                           messages=page.items, next_cursor=page.next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following, a page at a time."""
     
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")  
 
     user = User.query.get_or_404(user_id)
+    page = IdPage(User
+                  .query
+                  .join(Follows, Follows.user_being_followed_id == User.id)
+                  .filter(Follows.user_following_id == user_id),
+                  Follows.user_being_followed_id,
+                  request.args.get('after', type=int), USERS_PER_PAGE)
 
-    return render_template('users/following.html', user=user)
+    return render_list('users/following.html', user=user, page=page)
 
 
 @app.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, a page at a time."""
     
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")    
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    page = IdPage(User
+                  .query
+                  .join(Follows, Follows.user_following_id == User.id)
+                  .filter(Follows.user_being_followed_id == user_id),
+                  Follows.user_following_id,
+                  request.args.get('after', type=int), USERS_PER_PAGE)
+
+    return render_list('users/followers.html', user=user, page=page)
 
 @app.route('/users/<int:user_id>/likes')
 def users_likes(user_id):  
@@ -187,8 +417,17 @@ def users_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    page = paginate(feeds.with_authors(feeds.liked_messages(user_id)),
+                    None, Likes.message_id, request_cursor(),
+                    fetch=feeds.fetch_messages)
+
+    cached = not_modified(user.snapshot(),
+                          messages_stamp(page.items, page.next_cursor))
+    if cached:
+        return cached
 
-    return render_template('users/likes.html', user=user, messages=user.likes)
+    return render_list('users/likes.html', user=user,
+                           messages=page.items, next_cursor=page.next_cursor)
 
 @app.route('/users/add_like/<int:message_id>', methods=["POST"]) 
 def add_like(message_id):
@@ -198,12 +437,29 @@ def add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get(message_id)
-    if message in g.user.likes:
-        g.user.likes.remove(message)
+    # the button posts the state it asks for, so a double submit is a no-op;
+    # without it, the like is toggled
+    liked = request.form.get('liked')
+    if liked is None:
+        liked = not g.membership.has_liked(message_id)
     else:
-        g.user.likes.append(message)
-    db.session.commit()    
+        liked = liked == '1'
+
+    try:
+        if liked:
+            Likes.add(g.user.id, message_id)
+            g.membership.liked(message_id)
+        else:
+            Likes.remove(g.user.id, message_id)
+            g.membership.unliked(message_id)
+        db.session.commit()
+
+    except IntegrityError:
+        # no such message
+        db.session.rollback()
+        abort(404)
+
+    invalidate_user(g.user.id)
     page = request.form.get("page")        
 
     return redirect(f"{page}")    
@@ -216,9 +472,20 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    try:
+        if Follows.add(g.user.id, follow_id):
+            feeds.followers_changed(follow_id)
+            feeds.backfill_follow(g.user.id, follow_id)
+        db.session.commit()
+
+    except IntegrityError:
+        # no such user
+        db.session.rollback()
+        abort(404)
+
+    g.membership.followed(follow_id)
+    invalidate_user(g.user.id)
+    invalidate_user(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -231,9 +498,13 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    if Follows.remove(g.user.id, follow_id):
+        feeds.remove_follow(g.user.id, follow_id)
+        feeds.followers_changed(follow_id)
     db.session.commit()
+    g.membership.unfollowed(follow_id)
+    invalidate_user(g.user.id)
+    invalidate_user(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -251,18 +522,23 @@ def profile():
     if form.validate_on_submit():
         try:
             
-            g.user.username=form.username.data,
-            g.user.email=form.email.data,
-            g.user.image_url=form.image_url.data or User.image_url.default.arg,
-            g.user.header_image_url=form.header_image_url.data or User.header_image_url.default.arg
-            g.user.bio=form.bio.data
+            g.user.username = form.username.data
+            g.user.email = form.email.data
+            g.user.image_url = form.image_url.data or User.image_url.default.arg
+            g.user.header_image_url = form.header_image_url.data or User.header_image_url.default.arg
+            g.user.bio = form.bio.data
 
             db.session.commit()
+            invalidate_user(g.user.id)
+            fragments.user_changed(g.user.id)
+            user_added(g.user.id, g.user.username)
             return redirect(f"/users/{g.user.id}")  
 
         except IntegrityError:
+            db.session.rollback()
+            invalidate_user(g.user_id)
             flash("Username already taken", 'danger')
-            return redirect('users/profile', form=form)   
+            return render_template("users/edit.html", form=form)
                 
     return render_template("users/edit.html", form=form)
 
@@ -276,9 +552,41 @@ def delete_user():
 
     do_logout()
 
+    # the cascade takes this user's follows and their messages' likes with
+    # it, so the counters of everyone on the other side need recounting
+    affected_ids = [
+        user_id for (user_id,) in db.session.query(Follows.user_following_id)
+        .filter(Follows.user_being_followed_id == g.user.id)
+        .union(db.session.query(Follows.user_being_followed_id)
+               .filter(Follows.user_following_id == g.user.id))
+        .union(db.session.query(Likes.user_id)
+               .join(Message, Message.id == Likes.message_id)
+               .filter(Message.user_id == g.user.id))
+    ]
+
+    # and the messages this user liked lose a like each
+    (Message
+     .query
+     .filter(Message.id.in_(db.select([Likes.message_id])
+                            .where(Likes.user_id == g.user.id)))
+     .update({Message.likes_count: Message.likes_count - 1},
+             synchronize_session=False))
+
+    # pulled authors this user follows may drop back to being pushed
+    pulled_ids = feeds.pulled_following_ids(g.user.id)
+
     db.session.delete(g.user)
+    db.session.flush()
+    User.recount(affected_ids)
+    for user_id in pulled_ids:
+        feeds.followers_changed(user_id)
     db.session.commit()
 
+    for user_id in [g.user_id, *affected_ids]:
+        invalidate_user(user_id)
+    fragments.user_changed(g.user_id)
+    user_removed(g.user_id)
+
     return redirect("/signup")    
 
 ##############################################################################
@@ -300,7 +608,11 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        User.adjust_counts(g.user.id, messages_count=1)
+        db.session.flush()
+        feeds.fan_out_message(msg)
         db.session.commit()
+        invalidate_user(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -311,7 +623,12 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+
+    cached = not_modified(messages_stamp([msg]))
+    if cached:
+        return cached
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -323,13 +640,57 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+    author_id = msg.user_id
+    liker_ids = [user_id for (user_id,) in db.session.query(Likes.user_id)
+                 .filter(Likes.message_id == msg.id)]
+    User.adjust_counts(author_id, messages_count=-1)
+    if liker_ids:
+        User.adjust_counts(liker_ids, likes_count=-1)
+    feeds.remove_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    for user_id in [author_id, *liker_ids]:
+        invalidate_user(user_id)
+    fragments.message_removed(message_id, author_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Recompute the denormalized counters of every user and message."""
+
+    User.recount()
+    Message.recount()
+    db.session.commit()
+    click.echo(f"Recounted {User.query.count()} users and "
+               f"{Message.query.count()} messages.")
+
+
+@app.cli.command('check-plans')
+@click.argument('user_id', type=int, required=False)
+def check_plans(user_id):
+    """EXPLAIN the feed queries; fail unless they are index range scans."""
+
+    if user_id is None:
+        user_id = db.session.query(db.func.min(User.id)).scalar() or 0
+
+    failed = False
+    for name, (plan, full_scans) in plans.check_feed_plans(user_id).items():
+        click.echo(f"{name}: {'FULL SCAN' if full_scans else 'ok'}")
+        for line in plan:
+            click.echo(f"    {line}")
+        failed = failed or bool(full_scans)
+
+    if failed:
+        raise click.ClickException("feed queries are not index range scans")
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -339,38 +700,22 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, read from
+      the user's precomputed timeline (see feeds.py) a page at a time
+
+    Either way a client that has the current version gets a 304 (see
+    conditional.py).
     """
 
     if g.user:
-        user_ids = [user.id for user in g.user.following]
-        user_ids.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-    
-        return render_template('home.html', messages=messages)
+        page = feeds.home_feed(g.user, request_cursor())
 
-    else:
-        return render_template('home-anon.html')
+        cached = not_modified(messages_stamp(page.items, page.next_cursor))
+        if cached:
+            return cached
 
+        return render_template('home.html', messages=page.items,
+                               next_cursor=page.next_cursor)
 
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    else:
+        return not_modified() or render_template('home-anon.html')
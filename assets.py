@@ -0,0 +1,170 @@
+"""Fingerprinted static assets.
+
+`flask build-assets` copies every file under static/ into static/dist/ with
+a hash of its contents in the name (style.css -> style.3f2a9c1d0b4e.css),
+writes gzip (and, if the `brotli` package is installed, brotli) versions of
+text assets next to them, and records the names in dist/manifest.json.
+
+Templates link to assets with asset_url('stylesheets/style.css'), which
+resolves through the manifest to /static/dist/<hashed name>. As a name
+only ever has one content, those responses are cached as immutable, and
+the precompressed version matching the request's Accept-Encoding is sent.
+Without a build (e.g. in development) asset_url() falls back to the plain
+file with a ?v= hash (see conditional.static_url).
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+
+from conditional import static_url
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+
+# Extensions worth precompressing; images are compressed already.
+COMPRESSIBLE = {'.css', '.js', '.svg', '.txt', '.ico'}
+
+# (Content-Encoding, file suffix), in order of preference.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+_manifests = {}
+
+
+def fingerprint(path):
+    """Short hash of a file's contents."""
+
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def _compress(path):
+    """Write .gz (and .br) versions of `path` where they are smaller."""
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    variants = [('.gz', gzip.compress(data, compresslevel=9))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data)))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+def build(static_dir, dist_dir):
+    """Fingerprint and precompress everything in `static_dir` into `dist_dir`.
+
+    Returns the manifest: {original name: fingerprinted name}, relative to
+    the two directories.
+    """
+
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+
+    manifest = {}
+
+    for root, dirs, names in os.walk(static_dir):
+        dirs[:] = [name for name in dirs
+                   if os.path.join(root, name) != dist_dir]
+
+        for name in sorted(names):
+            source = os.path.join(root, name)
+            rel_path = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            base, ext = os.path.splitext(rel_path)
+            hashed = f"{base}.{fingerprint(source)}{ext}"
+
+            target = os.path.join(dist_dir, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+
+            if ext.lower() in COMPRESSIBLE:
+                _compress(target)
+
+            manifest[rel_path] = hashed
+
+    with open(os.path.join(dist_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(dist_dir):
+    """The manifest in `dist_dir` ({} if not built), reread if it changes."""
+
+    path = os.path.join(dist_dir, MANIFEST_NAME)
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+
+    cached = _manifests.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = _manifests[path] = (mtime, json.load(f))
+
+    return cached[1]
+
+
+def asset_url(filename):
+    """URL of a static file: fingerprinted if built, else versioned."""
+
+    hashed = load_manifest(current_app.config['ASSETS_DIR']).get(filename)
+    if hashed is None:
+        return static_url(filename)
+
+    return url_for('asset', filename=hashed)
+
+
+def send_asset(filename):
+    """Serve a fingerprinted asset, precompressed if the client accepts it."""
+
+    dist_dir = current_app.config['ASSETS_DIR']
+
+    for encoding, suffix in ENCODINGS:
+        if (encoding in request.accept_encodings
+                and os.path.isfile(os.path.join(dist_dir, filename + suffix))):
+            # typed as the original file, not as a .gz/.br archive
+            mimetype = (mimetypes.guess_type(filename)[0]
+                        or 'application/octet-stream')
+            response = send_from_directory(dist_dir, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(dist_dir, filename)
+
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    """Serve built assets and add the build-assets command to `app`."""
+
+    app.config.setdefault('ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+
+    app.add_url_rule(f"{app.static_url_path}/dist/<path:filename>", 'asset',
+                     send_asset)
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    @app.cli.command('build-assets')
+    def build_assets():
+        """Fingerprint and precompress static/ into static/dist/."""
+
+        manifest = build(app.static_folder, app.config['ASSETS_DIR'])
+        click.echo(f"Built {len(manifest)} assets into "
+                   f"{app.config['ASSETS_DIR']}"
+                   + ("" if brotli else " (no brotli module: gzip only)"))
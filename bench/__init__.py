@@ -0,0 +1,19 @@
+"""End-to-end load and latency benchmarks for Warbler.
+
+Drives a weighted mix of the main views (home feed, profiles, the user
+directory and search, likes, follows and posting) as randomly chosen
+logged-in users, and reports p50/p95/p99 latency, throughput and SQL
+queries per request for each view. Requests go either through Flask's test
+client (in-process, the default) or over HTTP to a local threaded WSGI
+server running the same app.
+
+The database is whatever DATABASE_URL points at, as for the app itself.
+`seed` replaces everything in it, so it has to be set, and not to the
+app's development database:
+
+    export DATABASE_URL=postgresql:///warbler_bench
+    python -m bench seed --users 100000 --messages 1000000 --follows 2000000
+    python -m bench run --requests 5000 --out before.json
+    python -m bench run --transport http --concurrency 8 --out after.json
+    python -m bench compare before.json after.json
+"""
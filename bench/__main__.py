@@ -0,0 +1,95 @@
+"""Command line for the benchmarks: seed, run and compare (see bench/)."""
+
+import argparse
+import sys
+
+from bench import dataset, report
+from bench.scenarios import DEFAULT_MIX, parse_mix
+
+
+def seed_command(args):
+    dataset.seed(args.users, args.messages, args.follows, args.seed,
+                 args.shards, args.data_dir)
+
+
+def run_command(args):
+    from app import app
+    from bench.runner import run
+
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+
+    with app.app_context():
+        described = dataset.describe()
+
+    results, seconds = run(app, mix, args.iterations, args.concurrency,
+                           args.transport, args.seed, args.warmup)
+
+    result = report.build(
+        results, seconds,
+        {'transport': args.transport, 'concurrency': args.concurrency,
+         'iterations': args.iterations, 'seed': args.seed, 'mix': mix},
+        described)
+
+    report.print_report(result)
+
+    if args.out:
+        report.save(result, args.out)
+        print(f"saved to {args.out}")
+
+
+def compare_command(args):
+    regressions = report.compare(report.load(args.base), report.load(args.new),
+                                 args.threshold)
+
+    if regressions:
+        sys.exit(f"{len(regressions)} regression(s) over "
+                 f"{args.threshold:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench',
+                                     description="Warbler benchmarks.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    seed = commands.add_parser('seed', help="generate and load a dataset")
+    seed.add_argument('--users', type=int, default=10000)
+    seed.add_argument('--messages', type=int, default=100000)
+    seed.add_argument('--follows', type=int, default=200000)
+    seed.add_argument('--seed', type=int, default=0)
+    seed.add_argument('--shards', type=int, default=1)
+    seed.add_argument('--data-dir', default=dataset.DEFAULT_DATA_DIR)
+    seed.set_defaults(func=seed_command)
+
+    run = commands.add_parser('run', help="run a scenario mix")
+    run.add_argument('--iterations', type=int, default=1000,
+                     help="user actions to run (some make two requests)")
+    run.add_argument('--concurrency', type=int, default=1,
+                     help="worker threads")
+    run.add_argument('--transport', choices=['test-client', 'http'],
+                     default='test-client',
+                     help="in-process test client, or HTTP to a local server")
+    run.add_argument('--mix',
+                     help="weights like 'homepage=4,users_show=1' "
+                          "(default: a read-heavy mix of every view)")
+    run.add_argument('--warmup', type=int, default=50,
+                     help="unrecorded actions run first")
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--out', help="save the results as JSON")
+    run.set_defaults(func=run_command)
+
+    compare = commands.add_parser('compare',
+                                  help="compare two saved runs")
+    compare.add_argument('base')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float,
+                         default=report.DEFAULT_THRESHOLD,
+                         help="fraction a metric may worsen (default 0.10)")
+    compare.set_defaults(func=compare_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Benchmark datasets: generated CSVs loaded into the configured database."""
+
+import os
+import subprocess
+import sys
+from collections import namedtuple
+
+from sqlalchemy import func
+from sqlalchemy.engine.url import make_url
+
+from models import db, User, Message, Follows
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GENERATOR = os.path.join(ROOT, 'generator', 'create_csvs.py')
+DEFAULT_DATA_DIR = os.path.join(ROOT, 'bench', 'data')
+
+# How many ids of each kind a run picks its logged-in users, profiles and
+# liked messages from.
+SAMPLE_SIZE = 1000
+
+Sample = namedtuple('Sample', ['user_ids', 'usernames', 'message_ids'])
+
+
+def seed(users, messages, follows, seed=0, shards=1, data_dir=DEFAULT_DATA_DIR):
+    """Generate a dataset of the given size and load it, replacing the db.
+
+    The db has to be named in DATABASE_URL, and not be the app's
+    development database.
+    """
+
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        sys.exit("Set DATABASE_URL to the database to seed; "
+                 "seeding replaces everything in it.")
+
+    from loader import load
+    from app import DEFAULT_DATABASE_URL
+
+    def where(url):
+        url = make_url(url)
+        return (url.host, url.port, url.database)
+
+    if where(url) == where(DEFAULT_DATABASE_URL):
+        sys.exit(f"Refusing to seed the development database ({url}); "
+                 f"point DATABASE_URL at a benchmark database.")
+
+    subprocess.run(
+        [sys.executable, GENERATOR,
+         '--users', str(users), '--messages', str(messages),
+         '--follows', str(follows), '--seed', str(seed),
+         '--shards', str(shards), '--out', data_dir],
+        check=True)
+
+    load(data_dir)
+
+
+def describe():
+    """Row counts of the tables the benchmark exercises."""
+
+    return {
+        'users': User.query.count(),
+        'messages': Message.query.count(),
+        'follows': db.session.query(func.count(Follows.user_following_id)).scalar(),
+        'database': db.engine.dialect.name,
+    }
+
+
+def sample(size=SAMPLE_SIZE):
+    """Random existing user ids, usernames and message ids to request."""
+
+    users = (db.session.query(User.id, User.username)
+             .order_by(func.random()).limit(size).all())
+    message_ids = [id for id, in (db.session.query(Message.id)
+                                  .order_by(func.random()).limit(size))]
+
+    if not users or not message_ids:
+        sys.exit("The database is empty; run `python -m bench seed` first.")
+
+    return Sample([id for id, _ in users],
+                  [username for _, username in users],
+                  message_ids)
@@ -0,0 +1,141 @@
+"""Summarizing, saving and comparing benchmark results."""
+
+import json
+import subprocess
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from bench.dataset import ROOT
+
+PERCENTILES = (50, 95, 99)
+
+# A metric is a regression if it gets worse than this fraction.
+DEFAULT_THRESHOLD = 0.10
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of already sorted `values`."""
+
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def summarize(results, seconds):
+    """Latency, throughput and query stats for a list of Results."""
+
+    latencies = sorted(result.seconds * 1000 for result in results)
+    queries = sorted(result.queries for result in results)
+    statuses = Counter(result.status for result in results)
+
+    return {
+        'requests': len(results),
+        'errors': sum(count for status, count in statuses.items()
+                      if status >= 500),
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items())},
+        'throughput_rps': len(results) / seconds if seconds else 0,
+        'latency_ms': {
+            **{f"p{p}": percentile(latencies, p) for p in PERCENTILES},
+            'mean': sum(latencies) / len(latencies),
+            'max': latencies[-1],
+        },
+        'queries': {
+            'mean': sum(queries) / len(queries),
+            'p95': percentile(queries, 95),
+            'max': queries[-1],
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build(results, seconds, settings, dataset):
+    """The full report of a run: settings, overall and per-view stats."""
+
+    by_label = defaultdict(list)
+    for result in results:
+        by_label[result.label].append(result)
+
+    return {
+        'meta': {
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'git': git_revision(),
+            'dataset': dataset,
+            'seconds': seconds,
+            **settings,
+        },
+        'overall': summarize(results, seconds),
+        'views': {label: summarize(view_results, seconds)
+                  for label, view_results in sorted(by_label.items())},
+    }
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_report(report):
+    """Print the per-view stats of a report as a table."""
+
+    print(f"{'view':<20}{'reqs':>8}{'err':>6}{'rps':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}")
+
+    for label, stats in [*report['views'].items(),
+                         ('(all)', report['overall'])]:
+        latency = stats['latency_ms']
+        print(f"{label:<20}{stats['requests']:>8}{stats['errors']:>6}"
+              f"{stats['throughput_rps']:>9.1f}{latency['p50']:>9.2f}"
+              f"{latency['p95']:>9.2f}{latency['p99']:>9.2f}"
+              f"{stats['queries']['mean']:>9.1f}")
+
+
+def _changes(base, new):
+    """(metric, base value, new value, worse-is-higher) for two stats."""
+
+    for p in PERCENTILES:
+        yield (f"p{p} ms", base['latency_ms'][f"p{p}"],
+               new['latency_ms'][f"p{p}"], True)
+
+    yield ('queries', base['queries']['mean'], new['queries']['mean'], True)
+    yield ('rps', base['throughput_rps'], new['throughput_rps'], False)
+
+
+def compare(base, new, threshold=DEFAULT_THRESHOLD):
+    """Print how `new` differs from `base`, view by view.
+
+    Returns the list of (view, metric) pairs that regressed by more than
+    `threshold` (e.g. 0.10 for 10%).
+    """
+
+    regressions = []
+    views = [*sorted(set(base['views']) & set(new['views'])), '(all)']
+
+    print(f"{'view':<20}{'metric':<10}{'base':>10}{'new':>10}{'change':>9}")
+
+    for view in views:
+        base_stats = base['overall'] if view == '(all)' else base['views'][view]
+        new_stats = new['overall'] if view == '(all)' else new['views'][view]
+
+        for metric, old, now, higher_is_worse in _changes(base_stats, new_stats):
+            change = (now - old) / old if old else 0.0
+            worse = change > threshold if higher_is_worse else -change > threshold
+
+            if worse:
+                regressions.append((view, metric))
+
+            print(f"{view:<20}{metric:<10}{old:>10.2f}{now:>10.2f}"
+                  f"{change:>+9.1%}{'  REGRESSION' if worse else ''}")
+
+    return regressions
@@ -0,0 +1,169 @@
+"""Running a benchmark: transports, logged-in sessions and the worker loop."""
+
+import http.client
+import itertools
+import random
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from flask import request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import CURR_USER_KEY
+from bench import dataset
+from bench.scenarios import SCENARIOS
+
+Result = namedtuple('Result', ['label', 'status', 'seconds', 'queries'])
+
+
+def session_cookie(app, user_id):
+    """A `Cookie` header value logging the client in as `user_id`.
+
+    Built through the app's own session interface, the same way a login
+    would, so it works whatever the session backend is.
+    """
+
+    with app.test_request_context():
+        session = app.session_interface.open_session(app, request)
+        session[CURR_USER_KEY] = user_id
+
+        response = app.response_class()
+        app.session_interface.save_session(app, session, response)
+
+    return response.headers['Set-Cookie'].split(';')[0]
+
+
+class TestClientTransport:
+    """Requests through Flask's test client, in this process and thread."""
+
+    name = 'test-client'
+
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+        self.cookie = None
+        self.results = []
+
+    def request(self, label, method, path, data=None):
+        started = time.perf_counter()
+        response = self.client.open(path, method=method, data=data,
+                                    headers={'Cookie': self.cookie})
+        seconds = time.perf_counter() - started
+
+        self.results.append(Result(
+            label, response.status_code, seconds,
+            int(response.headers.get('X-Query-Count', 0))))
+        response.close()
+
+
+class HTTPTransport:
+    """Requests over HTTP, one connection per request."""
+
+    name = 'http'
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookie = None
+        self.results = []
+
+    def request(self, label, method, path, data=None):
+        headers = {'Cookie': self.cookie}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection(self.host, self.port)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+        finally:
+            conn.close()
+        seconds = time.perf_counter() - started
+
+        self.results.append(Result(
+            label, response.status, seconds,
+            int(response.getheader('X-Query-Count', 0))))
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Werkzeug's request handler, without a log line per request."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class LocalServer:
+    """The app on a threaded WSGI server on a free localhost port."""
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+    def transport(self):
+        return HTTPTransport('127.0.0.1', self.server.server_port)
+
+
+def run(app, mix, iterations, concurrency=1, transport='test-client', seed=0,
+        warmup=50):
+    """Run `iterations` scenarios drawn from `mix` over `concurrency` workers.
+
+    Returns (results, wall-clock seconds). A `warmup` of scenarios is run
+    first and not recorded, so one-off startup work isn't measured.
+    """
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        sample = dataset.sample()
+        cookies = {user_id: session_cookie(app, user_id)
+                   for user_id in sample.user_ids}
+
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    remaining = itertools.count()
+
+    def work(client, rng, count):
+        while next(remaining) < count:
+            client.cookie = cookies[rng.choice(sample.user_ids)]
+            scenario = SCENARIOS[rng.choices(names, weights)[0]]
+            scenario(client, rng, sample)
+
+    def run_with(make_transport):
+        work(make_transport(), random.Random(f"{seed}-warmup"), warmup)
+
+        nonlocal remaining
+        remaining = itertools.count()
+        clients = [make_transport() for _ in range(concurrency)]
+        threads = [threading.Thread(target=work,
+                                    args=(client, random.Random(f"{seed}-{i}"),
+                                          iterations))
+                   for i, client in enumerate(clients)]
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+
+        return [result for client in clients for result in client.results], seconds
+
+    if transport == 'http':
+        with LocalServer(app) as server:
+            return run_with(server.transport)
+
+    return run_with(lambda: TestClientTransport(app))
@@ -0,0 +1,90 @@
+"""The user actions a benchmark run is made of, and how often each happens.
+
+Each scenario makes one or more requests as a logged-in user through a
+transport (see runner.py), labelling each with the view it exercises.
+"""
+
+from urllib.parse import quote
+
+# Relative weights of the default mix: mostly reading feeds and profiles,
+# with some browsing, and a trickle of writes.
+DEFAULT_MIX = {
+    'homepage': 40,
+    'users_show': 25,
+    'list_users': 15,
+    'add_like': 10,
+    'add_follow': 5,
+    'messages_add': 5,
+}
+
+WORDS = ("just setting up my warbler the coffee here is great cannot believe "
+         "what happened today anyone else watching the game tonight").split()
+
+
+def homepage(client, rng, sample):
+    client.request('homepage', 'GET', '/')
+
+
+def users_show(client, rng, sample):
+    client.request('users_show', 'GET', f"/users/{rng.choice(sample.user_ids)}")
+
+
+def list_users(client, rng, sample):
+    """Half directory pages, half searches for a typed username prefix."""
+
+    if rng.random() < 0.5:
+        client.request('list_users', 'GET', '/users')
+    else:
+        username = rng.choice(sample.usernames)
+        term = username[:rng.randint(2, 4)]
+        client.request('list_users_search', 'GET', f"/users?q={quote(term)}")
+
+
+def add_like(client, rng, sample):
+    """Like (or, if already liked, unlike) a random message."""
+
+    client.request('add_like', 'POST',
+                   f"/users/add_like/{rng.choice(sample.message_ids)}",
+                   {'page': '/'})
+
+
+def add_follow(client, rng, sample):
+    """Follow a random user, then unfollow them to keep the graph stable."""
+
+    user_id = rng.choice(sample.user_ids)
+    client.request('add_follow', 'POST', f"/users/follow/{user_id}")
+    client.request('stop_following', 'POST', f"/users/stop-following/{user_id}")
+
+
+def messages_add(client, rng, sample):
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+    client.request('messages_add', 'POST', '/messages/new',
+                   {'text': text.capitalize()})
+
+
+SCENARIOS = {
+    'homepage': homepage,
+    'users_show': users_show,
+    'list_users': list_users,
+    'add_like': add_like,
+    'add_follow': add_follow,
+    'messages_add': messages_add,
+}
+
+
+def parse_mix(spec):
+    """Turn 'homepage=3,users_show=1' into {'homepage': 3, 'users_show': 1}."""
+
+    mix = {}
+
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+
+        if name not in SCENARIOS:
+            raise ValueError(f"unknown scenario {name!r}; "
+                             f"choose from {', '.join(SCENARIOS)}")
+
+        mix[name] = float(weight) if weight else 1.0
+
+    return mix
@@ -0,0 +1,267 @@
+"""Response compression, as WSGI middleware around the Flask app.
+
+Text responses (HTML, CSS, JSON, ...) of at least COMPRESSION_MIN_SIZE
+bytes are sent brotli- (if the `brotli` package is installed) or
+gzip-compressed, whichever the client prefers. Bodies are read up to that
+size to decide; whole bodies are compressed in one go, while a body that is
+still streaming (see stream_template) is compressed chunk by chunk as it
+is produced.
+
+Responses with an ETag (static files, and pages tagged by conditional.py,
+whose ETag names the exact data rendered) always compress to the same
+bytes, so their compressed variants are kept in an LRU cache keyed on
+(path, ETag, encoding).
+
+CPU time spent compressing is recorded in the instrumentation metrics and,
+when known before the headers go out, in the Server-Timing header.
+"""
+
+import time
+import zlib
+
+from werkzeug.http import parse_accept_header, parse_options_header
+
+from cache import LRUCache
+from instrumentation import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {'application/javascript', 'application/json',
+                      'application/xml', 'image/svg+xml'}
+
+SKIPPED_STATUSES = (204, 206, 304)
+
+
+def _accepted_encoding(environ):
+    """'br', 'gzip' or None: the best encoding this client takes."""
+
+    accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+
+    return None
+
+
+def _compress_all(encoding, level, data):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+
+    # wbits 31: zlib's deflate with a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _stream_compressor(encoding, level):
+    """(compress_chunk, finish) functions for a streamed body.
+
+    Each chunk is flushed, so the client can use what it has so far.
+    """
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        return (lambda chunk: compressor.process(chunk) + compressor.flush(),
+                compressor.finish)
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return (lambda chunk: (compressor.compress(chunk)
+                           + compressor.flush(zlib.Z_SYNC_FLUSH)),
+            compressor.flush)
+
+
+def _get_header(headers, name):
+    name = name.lower()
+    return next((value for key, value in headers if key.lower() == name), None)
+
+
+def _set_header(headers, name, value):
+    lowered = name.lower()
+    headers[:] = [(key, v) for key, v in headers if key.lower() != lowered]
+    if value is not None:
+        headers.append((name, value))
+
+
+def _add_vary(headers):
+    vary = _get_header(headers, 'Vary')
+    if not vary:
+        _set_header(headers, 'Vary', 'Accept-Encoding')
+    elif 'accept-encoding' not in vary.lower():
+        _set_header(headers, 'Vary', f"{vary}, Accept-Encoding")
+
+
+def _weak_etag(etag):
+    """The compressed bytes differ from the original: weaken its ETag."""
+
+    return etag if etag.startswith('W/') else f"W/{etag}"
+
+
+class CompressionMiddleware:
+    """Compress the responses of `wsgi_app` for clients that accept it."""
+
+    def __init__(self, wsgi_app, min_size=500, gzip_level=6, brotli_level=4,
+                 cache_size=512):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size
+        self.levels = {'gzip': gzip_level, 'br': brotli_level}
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def __call__(self, environ, start_response):
+        encoding = _accepted_encoding(environ)
+
+        if encoding is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured['args'] = (status, list(headers), exc_info)
+            return lambda data: captured.setdefault('written', []).append(data)
+
+        app_iter = self.wsgi_app(environ, capture)
+        status, headers, exc_info = captured['args']
+
+        if not self._compressible(status, headers):
+            write = start_response(status, headers, exc_info)
+            for data in captured.get('written', []):
+                write(data)
+            return app_iter
+
+        return self._compress(environ, encoding, app_iter, captured,
+                              start_response)
+
+    def _compressible(self, status, headers):
+        if int(status.split(' ', 1)[0]) in SKIPPED_STATUSES:
+            return False
+
+        if _get_header(headers, 'Content-Encoding'):
+            return False
+
+        if 'no-transform' in (_get_header(headers, 'Cache-Control') or ''):
+            return False
+
+        length = _get_header(headers, 'Content-Length')
+        if length is not None and int(length) < self.min_size:
+            return False
+
+        mimetype, _ = parse_options_header(_get_header(headers, 'Content-Type'))
+        return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+    def _compress(self, environ, encoding, app_iter, captured, start_response):
+        status, headers, exc_info = captured['args']
+        chunks = list(captured.get('written', []))
+        size = sum(len(chunk) for chunk in chunks)
+
+        # read enough of the body to know if it is worth compressing
+        body = iter(app_iter)
+        finished = False
+        while size < self.min_size:
+            try:
+                chunk = next(body)
+            except StopIteration:
+                finished = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+
+        if finished and size < self.min_size:
+            _close(app_iter)
+            start_response(status, headers, exc_info)
+            return chunks
+
+        _set_header(headers, 'Content-Encoding', encoding)
+        _add_vary(headers)
+
+        etag = _get_header(headers, 'ETag')
+        if etag:
+            _set_header(headers, 'ETag', _weak_etag(etag))
+
+        if not finished and _get_header(headers, 'Content-Length') is None:
+            # still streaming: compress each chunk as it comes
+            _set_header(headers, 'Content-Length', None)
+            start_response(status, headers, exc_info)
+            return self._stream(encoding, chunks, body, app_iter)
+
+        chunks.extend(body)
+        _close(app_iter)
+        data = b''.join(chunks)
+
+        key = etag and (environ.get('PATH_INFO'), environ.get('QUERY_STRING'),
+                        etag, encoding)
+        compressed = key and self.cache.get(key)
+
+        if compressed is not None:
+            metrics.incr('compression.cache_hits')
+        else:
+            started = time.thread_time()
+            compressed = _compress_all(encoding, self.levels[encoding], data)
+            cpu_ms = (time.thread_time() - started) * 1000
+
+            self._record(encoding, cpu_ms, len(data), len(compressed))
+            headers.append(('Server-Timing',
+                            f'{encoding};dur={cpu_ms:.2f};desc="compression"'))
+            if key:
+                self.cache.set(key, compressed)
+
+        _set_header(headers, 'Content-Length', str(len(compressed)))
+        start_response(status, headers, exc_info)
+        return [compressed]
+
+    def _stream(self, encoding, chunks, body, app_iter):
+        compress_chunk, finish = _stream_compressor(encoding,
+                                                    self.levels[encoding])
+        cpu_seconds = 0.0
+        size_in = size_out = 0
+
+        try:
+            for chunk in _chain(chunks, body):
+                started = time.thread_time()
+                out = compress_chunk(chunk)
+                cpu_seconds += time.thread_time() - started
+
+                size_in += len(chunk)
+                size_out += len(out)
+                if out:
+                    yield out
+
+            started = time.thread_time()
+            out = finish()
+            cpu_seconds += time.thread_time() - started
+
+            size_out += len(out)
+            yield out
+
+        finally:
+            _close(app_iter)
+            self._record(encoding, cpu_seconds * 1000, size_in, size_out)
+
+    @staticmethod
+    def _record(encoding, cpu_ms, size_in, size_out):
+        metrics.observe(f"compression.{encoding}.cpu_ms", cpu_ms)
+        metrics.incr('compression.bytes_in', size_in)
+        metrics.incr('compression.bytes_out', size_out)
+
+
+def _chain(chunks, body):
+    yield from chunks
+    yield from body
+
+
+def _close(app_iter):
+    if hasattr(app_iter, 'close'):
+        app_iter.close()
+
+
+def init_app(app):
+    """Wrap `app`'s WSGI callable in compression, configured from its config."""
+
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config['COMPRESSION_MIN_SIZE'],
+        gzip_level=app.config['COMPRESSION_GZIP_LEVEL'],
+        brotli_level=app.config['COMPRESSION_BROTLI_LEVEL'],
+        cache_size=app.config['COMPRESSION_CACHE_SIZE'])
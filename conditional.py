@@ -0,0 +1,136 @@
+"""Conditional GET (ETag / If-None-Match) for the feed, profile and message
+pages.
+
+A page's ETag is a hash of the data it is rendered from, worked out from
+rows the view has loaded anyway: the profile's user row, the ids and
+authors of the messages on the page, and the viewer's own row and follow /
+like id sets (for the navbar, counters and buttons). A view calls
+not_modified() with that data before rendering; if the client already
+holds that version it gets an empty 304 and no template is rendered.
+
+Static files are served with long-lived caching. Templates link to them
+through asset_url() (see assets.py) or static_url(), whose fingerprinted
+name or ?v= content hash changes whenever the file does, so they can be
+marked immutable.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, g, request, session, url_for
+
+# Cache-Control of pages with an ETag: private (they depend on the viewer)
+# and revalidated on every use.
+PAGE_CACHE_CONTROL = 'private, no-cache'
+
+# Versioned static URLs never change content; plain ones (e.g. image paths
+# stored in user rows) are cached for a day.
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+UNVERSIONED_STATIC_MAX_AGE = 24 * 60 * 60
+
+_static_versions = {}
+
+
+def _template_version(app):
+    """Changes whenever a template does, so deploys change every ETag."""
+
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    mtimes = [os.path.getmtime(os.path.join(root, name))
+              for root, _, names in os.walk(template_dir)
+              for name in names]
+
+    return str(max(mtimes, default=0))
+
+
+def viewer_stamp():
+    """What the logged-in viewer contributes to every page."""
+
+    if g.get('user_id') is None or not g.user:
+        return None
+
+    return (g.user.snapshot(),
+            hash(frozenset(g.membership.following_ids)),
+            hash(frozenset(g.membership.liked_ids)))
+
+
+def messages_stamp(messages, next_cursor=None):
+    """The parts of a page of messages that its items are rendered from.
+
+    Message text and timestamps never change, so ids stand in for them.
+    """
+
+    return (next_cursor, [(msg.id, msg.likes_count, msg.user.username,
+                           msg.user.image_url)
+                          for msg in messages])
+
+
+def make_etag(*parts):
+    raw = repr((current_app.config['ETAG_VERSION'], request.full_path,
+                viewer_stamp(), parts))
+
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def not_modified(*parts):
+    """Tag this response with an ETag of `parts` (and the viewer).
+
+    Returns a 304 response if the request's If-None-Match already has that
+    ETag, else None and the view goes on to render. Pages with pending
+    flash messages are never tagged, as the flashes have to be shown.
+    """
+
+    if session.get('_flashes'):
+        return None
+
+    g.etag = make_etag(*parts)
+
+    if request.if_none_match.contains_weak(g.etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def static_url(filename):
+    """URL of a static file, versioned by a hash of its contents."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    mtime = os.path.getmtime(path)
+
+    cached = _static_versions.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()[:12]
+        cached = _static_versions[filename] = (mtime, digest)
+
+    return url_for('static', filename=filename, v=cached[1])
+
+
+def caching_headers(response):
+    """Set Cache-Control (and ETag) for static files and tagged pages."""
+
+    if request.endpoint in ('static', 'asset'):
+        if request.endpoint == 'asset' or 'v' in request.args:
+            response.headers['Cache-Control'] = (
+                f'public, max-age={STATIC_MAX_AGE}, immutable')
+        else:
+            response.headers['Cache-Control'] = (
+                f'public, max-age={UNVERSIONED_STATIC_MAX_AGE}')
+
+    elif g.get('etag') and response.status_code in (200, 304):
+        response.set_etag(g.etag, weak=True)
+        response.headers['Cache-Control'] = PAGE_CACHE_CONTROL
+
+    else:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+
+    return response
+
+
+def init_app(app):
+    """Add the caching headers to every response of `app`."""
+
+    app.config.setdefault('ETAG_VERSION', _template_version(app))
+    app.after_request(caching_headers)
+    app.jinja_env.globals['static_url'] = static_url
@@ -0,0 +1,334 @@
+"""Home timeline fan-out for Warbler.
+
+Each user's home feed is stored precomputed in the `timelines` table:
+posting a message writes one row per follower, and following/unfollowing
+copies or removes the followed user's messages. Reading the home page is
+then a single range over (owner_id, timestamp).
+
+Accounts with more than FEED_FANOUT_THRESHOLD followers are not pushed:
+their messages would cost one write per follower. Instead their followers
+pull them at read time and `home_feed` merges both sources by timestamp.
+Which mode an author is in is stored (User.feed_pulled) and only switched
+by `followers_changed`, which pushes whatever was missed when an author
+goes back to being pushed.
+"""
+
+import heapq
+from collections import namedtuple
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import exists, literal, select
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, Follows, Likes, Message, Timeline, User
+from pagination import PER_PAGE, keyset, page_of
+
+TIMELINE_COLUMNS = ['owner_id', 'message_id', 'timestamp']
+
+DEFAULT_FANOUT_THRESHOLD = 10000
+
+# A pulled author is pushed again only once their follower count is back
+# down to this fraction of the threshold, so an author hovering around it
+# doesn't switch (and backfill every follower) on each follow and unfollow.
+PUSH_AGAIN_BELOW = 0.9
+
+AUTHOR_LOADING_STRATEGIES = ('selectin', 'joined', 'lean')
+
+# What the 'lean' strategy loads instead of full Message and User rows:
+# just the columns the message list templates read.
+Author = namedtuple('Author', ['id', 'username', 'image_url'])
+LeanMessage = namedtuple('LeanMessage',
+                         ['id', 'text', 'timestamp', 'user_id', 'likes_count',
+                          'user'])
+
+
+def author_loading():
+    """The configured FEED_AUTHOR_LOADING strategy."""
+
+    strategy = current_app.config.get('FEED_AUTHOR_LOADING', 'selectin')
+
+    if strategy not in AUTHOR_LOADING_STRATEGIES:
+        raise ValueError(f"Unknown FEED_AUTHOR_LOADING: {strategy!r}")
+
+    return strategy
+
+
+def with_authors(query, strategy=None):
+    """Make a Message query load each message's author up front.
+
+    Without this, templates reading msg.user cost one SELECT per author.
+    'selectin' loads the authors in a second IN() query, 'joined' joins
+    them into the same query, and 'lean' selects only the message and
+    author columns the templates need (see `fetch_messages`).
+    """
+
+    strategy = strategy or author_loading()
+
+    if strategy == 'lean':
+        return (query
+                .join(User, User.id == Message.user_id)
+                .with_entities(Message.id, Message.text, Message.timestamp,
+                               Message.user_id, Message.likes_count,
+                               User.username, User.image_url))
+
+    loader = joinedload if strategy == 'joined' else selectinload
+    return query.options(loader(Message.user))
+
+
+def fetch_messages(query):
+    """Run a `with_authors` query, returning message-like objects."""
+
+    rows = query.all()
+
+    if rows and not isinstance(rows[0], Message):
+        return [LeanMessage(row.id, row.text, row.timestamp, row.user_id,
+                            row.likes_count,
+                            Author(row.user_id, row.username, row.image_url))
+                for row in rows]
+
+    return rows
+
+
+def fanout_threshold():
+    """Follower count above which an author's messages are pulled."""
+
+    return current_app.config.get('FEED_FANOUT_THRESHOLD',
+                                  DEFAULT_FANOUT_THRESHOLD)
+
+
+def follower_count(user_id):
+    """Number of followers of `user_id`, from the denormalized counter."""
+
+    return (db.session
+            .query(User.followers_count)
+            .filter(User.id == user_id)
+            .scalar()) or 0
+
+
+def is_pulled(user_id):
+    """Are `user_id`'s messages pulled at read time instead of pushed?"""
+
+    return bool(db.session
+                .query(User.feed_pulled)
+                .filter(User.id == user_id)
+                .scalar())
+
+
+def pulled_following_ids(user_id):
+    """Ids of the users `user_id` follows whose messages are pulled."""
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    User.feed_pulled))
+
+    return [user_id for (user_id,) in rows]
+
+
+def followers_changed(user_id, threshold=None):
+    """Switch `user_id` between pushed and pulled after a follow or unfollow.
+
+    Over `threshold` followers an author's new messages stop being pushed.
+    Once back down to PUSH_AGAIN_BELOW of it, everything they posted while
+    pulled, and everything for followers gained meanwhile, is pushed to
+    their followers' timelines before pushing resumes.
+    """
+
+    if threshold is None:
+        threshold = fanout_threshold()
+
+    row = (db.session
+           .query(User.followers_count, User.feed_pulled)
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        return
+
+    followers, pulled = row
+
+    if not pulled and followers > threshold:
+        set_pulled(user_id, True)
+
+    elif pulled and followers <= threshold * PUSH_AGAIN_BELOW:
+        push_author(user_id)
+        set_pulled(user_id, False)
+
+
+def set_pulled(user_id, pulled):
+    """Record whether `user_id`'s messages are pulled."""
+
+    (User
+     .query
+     .filter(User.id == user_id)
+     .update({User.feed_pulled: pulled}, synchronize_session=False))
+
+
+def push_author(author_id):
+    """Copy all of `author_id`'s messages into their followers' timelines,
+    skipping those already there."""
+
+    delivered = (exists()
+                 .where(Timeline.owner_id == Follows.user_following_id)
+                 .where(Timeline.message_id == Message.id))
+
+    missing = (select([Follows.user_following_id, Message.id, Message.timestamp])
+               .select_from(Follows.__table__.join(
+                   Message.__table__,
+                   Message.user_id == Follows.user_being_followed_id))
+               .where(Follows.user_being_followed_id == author_id)
+               .where(~delivered))
+
+    db.session.execute(
+        Timeline.__table__.insert().from_select(TIMELINE_COLUMNS, missing))
+
+
+def fan_out_message(message):
+    """Deliver a newly-added `message` to its author and their followers.
+
+    Followers of a pulled (high-follower) author are skipped; they pick the
+    message up in `home_feed`. The message must have been flushed so that
+    it has an id.
+    """
+
+    db.session.add(Timeline(owner_id=message.user_id,
+                            message_id=message.id,
+                            timestamp=message.timestamp))
+
+    if is_pulled(message.user_id):
+        return
+
+    followers = select([
+        Follows.user_following_id,
+        literal(message.id),
+        literal(message.timestamp),
+    ]).where(Follows.user_being_followed_id == message.user_id)
+
+    db.session.execute(
+        Timeline.__table__.insert().from_select(TIMELINE_COLUMNS, followers))
+
+
+def backfill_follow(follower_id, followed_id):
+    """Copy `followed_id`'s messages into `follower_id`'s timeline.
+
+    Nothing is copied for a pulled author.
+    """
+
+    if is_pulled(followed_id):
+        return
+
+    messages = select([
+        literal(follower_id),
+        Message.id,
+        Message.timestamp,
+    ]).where(Message.user_id == followed_id)
+
+    db.session.execute(
+        Timeline.__table__.insert().from_select(TIMELINE_COLUMNS, messages))
+
+
+def remove_follow(follower_id, followed_id):
+    """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+    followed_messages = select([Message.id]).where(Message.user_id == followed_id)
+
+    (Timeline
+     .query
+     .filter(Timeline.owner_id == follower_id,
+             Timeline.message_id.in_(followed_messages))
+     .delete(synchronize_session=False))
+
+
+def remove_message(message):
+    """Remove `message` from every timeline it was delivered to."""
+
+    (Timeline
+     .query
+     .filter(Timeline.message_id == message.id)
+     .delete(synchronize_session=False))
+
+
+def author_messages(author_id):
+    """Query for `author_id`'s messages; page it by (timestamp, id)."""
+
+    return Message.query.filter(Message.user_id == author_id)
+
+
+def timeline_messages(owner_id):
+    """Query for the messages pushed to `owner_id`'s timeline; page it by
+    (Timeline.timestamp, Timeline.message_id)."""
+
+    return (Message
+            .query
+            .join(Timeline, Timeline.message_id == Message.id)
+            .filter(Timeline.owner_id == owner_id))
+
+
+def liked_messages(user_id):
+    """Query for the messages `user_id` likes; page it by Likes.message_id
+    alone, which walks the likes primary key."""
+
+    return (Message
+            .query
+            .join(Likes, Likes.message_id == Message.id)
+            .filter(Likes.user_id == user_id))
+
+
+def home_feed(user, before=None, per_page=PER_PAGE):
+    """Return a Page of `user`'s home timeline older than cursor `before`.
+
+    Merges the pushed timeline with the recent messages of every pulled
+    author `user` follows. Each source is already sorted newest-first, so
+    this is a k-way merge; a message can appear in both sources if its
+    author crossed the threshold after it was pushed, hence the de-dupe.
+    """
+
+    pushed = fetch_messages(keyset(
+        with_authors(timeline_messages(user.id)),
+        Timeline.timestamp, Timeline.message_id, before, per_page))
+
+    pulled = [fetch_messages(keyset(
+                  with_authors(author_messages(author_id)),
+                  Message.timestamp, Message.id, before, per_page))
+              for author_id in pulled_following_ids(user.id)]
+
+    if not pulled:
+        return page_of(pushed, per_page)
+
+    merged = heapq.merge(pushed, *pulled,
+                         key=lambda msg: (msg.timestamp, msg.id), reverse=True)
+    seen = set()
+    unique = (msg for msg in merged
+              if not (msg.id in seen or seen.add(msg.id)))
+
+    return page_of(list(islice(unique, per_page + 1)), per_page)
+
+
+def rebuild_timelines(threshold=DEFAULT_FANOUT_THRESHOLD):
+    """Recompute every timeline from the follows and messages tables.
+
+    Used after bulk loads (see seed.py), which bypass the write path.
+    Authors with more than `threshold` followers are marked pulled and
+    their messages only written to their own timeline. Counters must be
+    current (see User.recount).
+    """
+
+    (User
+     .query
+     .update({User.feed_pulled: User.followers_count > threshold},
+             synchronize_session=False))
+    Timeline.query.delete(synchronize_session=False)
+
+    own = select([Message.user_id, Message.id, Message.timestamp])
+    followed = (select([Follows.user_following_id, Message.id, Message.timestamp])
+                .select_from(Follows.__table__.join(
+                    Message.__table__,
+                    Message.user_id == Follows.user_being_followed_id))
+                .where(Follows.user_being_followed_id.notin_(
+                    select([User.id]).where(User.feed_pulled))))
+
+    db.session.execute(
+        Timeline.__table__.insert().from_select(TIMELINE_COLUMNS, own))
+    db.session.execute(
+        Timeline.__table__.insert().from_select(TIMELINE_COLUMNS, followed))
@@ -1,4 +1,3 @@
-from models import User
 from flask import g
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField
@@ -22,8 +21,7 @@ class UserAddForm(FlaskForm):
 def password_check(form, field):
     """Checks for valid user password"""
 
-    user = User.authenticate(g.user.username, field.data)
-    if not user:
+    if not g.user.check_password(field.data):
         raise ValidationError("Invalid password")
 
 class UserEditForm(FlaskForm):
@@ -0,0 +1,95 @@
+"""Cached HTML fragments for message list items and user cards.
+
+Rendering a message `<li>` or a user card is the same work for every viewer
+except for one button, so the rest is rendered once and kept in an LRU
+cache keyed on (kind, object id, version). The viewer's like or follow
+button is rendered fresh each time (see fragments/buttons.html) and put in
+place of the VIEWER_SLOT marker the cached body leaves for it.
+
+Message text and timestamps never change (like totals do, so they are
+rendered with the button), so the version in both keys is that of the user
+shown: the write paths in app.py call user_changed() when a profile is
+edited or deleted, which moves every fragment showing that user to a new
+key. Other processes' edits show up once their entries expire
+(FRAGMENT_CACHE_TTL).
+"""
+
+import itertools
+
+from flask import get_template_attribute, render_template
+from markupsafe import Markup
+
+from cache import LRUCache
+from instrumentation import metrics
+
+VIEWER_SLOT = '<!-- viewer -->'
+
+fragment_cache = LRUCache()
+
+_user_versions = {}
+_next_version = itertools.count(1)
+
+
+def user_version(user_id):
+    return _user_versions.get(user_id, 0)
+
+
+def user_changed(user_id):
+    """Retire the cached cards and message items showing `user_id`."""
+
+    _user_versions[user_id] = next(_next_version)
+
+
+def message_removed(message_id, author_id):
+    """Drop a deleted message's cached item."""
+
+    fragment_cache.pop(('message', message_id, user_version(author_id)))
+
+
+def _cached(key, template_name, **context):
+    body = fragment_cache.get(key)
+
+    if body is None:
+        metrics.incr('fragments.miss')
+        body = render_template(template_name, **context)
+        fragment_cache.set(key, body)
+    else:
+        metrics.incr('fragments.hit')
+
+    return body
+
+
+def _fill(body, viewer_part):
+    return Markup(body.replace(VIEWER_SLOT, viewer_part, 1))
+
+
+def message_item(message, author, page):
+    """A message's list item; `page` is where liking it redirects back to."""
+
+    body = _cached(('message', message.id, user_version(author.id)),
+                   'fragments/message.html', message=message, author=author)
+    like_button = get_template_attribute('fragments/buttons.html',
+                                         'like_button')
+
+    return _fill(body, like_button(message, page))
+
+
+def user_card(user):
+    """A user's card for the directory and follower/following lists."""
+
+    body = _cached(('user', user.id, user_version(user.id)),
+                   'fragments/user_card.html', user=user)
+    follow_button = get_template_attribute('fragments/buttons.html',
+                                           'follow_button')
+
+    return _fill(body, follow_button(user))
+
+
+def init_app(app):
+    """Size the cache from `app`'s config and expose the template helpers."""
+
+    fragment_cache.maxsize = app.config['FRAGMENT_CACHE_SIZE']
+    fragment_cache.ttl = app.config['FRAGMENT_CACHE_TTL']
+
+    app.jinja_env.globals.update(message_item=message_item,
+                                 user_card=user_card)
@@ -2,15 +2,31 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a benchmark dataset:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --shards 16 --out /data/bench
+
+Everything is sampled with NumPy from one --seed, so the same arguments
+(and --until date) always produce the same files, and nothing is fetched
+over the network.
+
+Followers follow a power law: a few users are followed by a large share of
+everyone, most by a handful. With --shards N each table is written as N
+files (users-0000.csv, ...) by a pool of processes; loader.py reads them in
+order, so user ids are 1..--users in file order.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from datetime import date, datetime, time
+from multiprocessing import Pool
+
+import numpy as np
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import power_law_weights, random_timestamps
 
 MAX_WARBLER_LENGTH = 140
 
@@ -22,9 +38,23 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# Skew of who gets followed and who posts; ~1 gives a Zipf-like long tail.
+FOLLOWED_EXPONENT = 1.0
+POSTING_EXPONENT = 0.8
+
+# No user gets more than this share of everyone else as followers, which
+# keeps rejection of duplicate pairs cheap.
+MAX_FOLLOWED_SHARE = 0.5
 
-# Generate random profile image URLs to use for users
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+POOL_SIZE = 1000
+
+# Rows generated and written at a time, which bounds a shard's memory use
+# however many rows it has.
+CHUNK_ROWS = 100000
+
+# Profile image URLs to use for users (not fetched here)
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +62,277 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header images shipped with the app, so generating needs no network
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
+    "/static/images/nav-bg.png",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def word_pools(seed):
+    """Name, city and word pools drawn once from a seeded Faker."""
+
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    return {
+        'first': np.array([fake.first_name().lower() for _ in range(POOL_SIZE)]),
+        'last': np.array([fake.last_name().lower() for _ in range(POOL_SIZE)]),
+        'city': np.array([fake.city() for _ in range(POOL_SIZE)]),
+        'word': np.array([fake.word() for _ in range(POOL_SIZE)]),
+    }
+
+
+def sentences(rng, words, count, min_words, max_words, max_length=None):
+    """`count` random sentences of pool words.
+
+    Builds a `count` x `max_words` array of words, so call it a chunk at a
+    time (see CHUNK_ROWS).
+    """
+
+    lengths = rng.integers(min_words, max_words + 1, size=count)
+    picks = words[rng.integers(0, len(words), size=(count, max_words))]
+
+    texts = (" ".join(row[:length]).capitalize() + "."
+             for row, length in zip(picks, lengths))
+
+    return [text[:max_length] for text in texts] if max_length else list(texts)
+
+
+def shard_path(out, table, shard, shards):
+    if shards == 1:
+        return os.path.join(out, f"{table}.csv")
+
+    return os.path.join(out, f"{table}-{shard:04d}.csv")
+
+
+def chunks(count):
+    """Sizes of the CHUNK_ROWS-at-most chunks `count` rows are made in."""
+
+    return [min(CHUNK_ROWS, count - start)
+            for start in range(0, count, CHUNK_ROWS)]
+
+
+def split(total, shards):
+    """[(start, stop)] ranges splitting range(total) into `shards` parts."""
+
+    bounds = np.linspace(0, total, shards + 1).astype(np.int64)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+##############################################################################
+# Shard writers (run in worker processes)
+
+
+def write_users(path, start, stop, seed_seq, pool_seed):
+    """Users with ids start+1..stop; usernames embed the id to stay unique."""
+
+    rng = np.random.default_rng(seed_seq)
+    pools = word_pools(pool_seed)
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.writer(users_csv)
+        users_writer.writerow(USERS_CSV_HEADERS)
+
+        first_id = start + 1
+        for count in chunks(stop - start):
+            ids = np.arange(first_id, first_id + count)
+            first_id += count
+
+            firsts = pools['first'][rng.integers(0, POOL_SIZE, size=count)]
+            lasts = pools['last'][rng.integers(0, POOL_SIZE, size=count)]
+            usernames = [f"{first}{last}{user_id}"
+                         for first, last, user_id in zip(firsts, lasts, ids)]
+
+            users_writer.writerows(zip(
+                (f"{username}@example.com" for username in usernames),
+                usernames,
+                np.array(image_urls)[
+                    rng.integers(0, len(image_urls), size=count)],
+                [PASSWORD] * count,
+                sentences(rng, pools['word'], count, 4, 10),
+                np.array(header_image_urls)[
+                    rng.integers(0, len(header_image_urls), size=count)],
+                pools['city'][rng.integers(0, POOL_SIZE, size=count)],
+            ))
+
+    return stop - start
+
+
+def write_messages(path, count, num_users, until, seed_seq, pool_seed):
+    """`count` messages, posted by users picked by power-law activity."""
+
+    rng = np.random.default_rng(seed_seq)
+    pools = word_pools(pool_seed)
+
+    # the same activity ranking in every shard: it comes from pool_seed
+    ranking = np.random.default_rng(pool_seed).permutation(num_users) + 1
+    cdf = np.cumsum(power_law_weights(num_users, POSTING_EXPONENT))
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.writer(messages_csv)
+        messages_writer.writerow(MESSAGES_CSV_HEADERS)
+
+        for size in chunks(count):
+            user_ids = ranking[np.searchsorted(cdf, rng.random(size) * cdf[-1])]
+
+            messages_writer.writerows(zip(
+                sentences(rng, pools['word'], size, 3, 30, MAX_WARBLER_LENGTH),
+                random_timestamps(rng, size, until).tolist(),
+                user_ids.tolist(),
+            ))
+
+    return count
+
+
+def sample_followers(rng, followed_ids, counts, num_users):
+    """Distinct (followed, follower) pairs, `counts[i]` for `followed_ids[i]`.
+
+    Followers are drawn uniformly from everyone but the followed user, in
+    vectorized rounds; duplicate pairs are dropped and only the shortfall
+    is drawn again, so no list of all possible pairs is ever built.
+    """
+
+    keys = np.empty(0, dtype=np.int64)
+    wanted = counts.copy()
+
+    while wanted.any():
+        followed = np.repeat(followed_ids, wanted)
+
+        # draw from 1..num_users-1 and skip over the followed user itself
+        followers = rng.integers(1, num_users, size=len(followed))
+        followers += followers >= followed
+
+        keys = np.unique(np.concatenate(
+            [keys, followed * (num_users + 1) + followers]))
+
+        have = np.bincount(np.searchsorted(followed_ids, keys // (num_users + 1)),
+                           minlength=len(followed_ids))
+        wanted = counts - have
+
+    return keys // (num_users + 1), keys % (num_users + 1)
+
+
+def write_follows(path, followed_ids, counts, num_users, seed_seq):
+    """The follows of users `followed_ids`, `counts` followers each."""
+
+    rng = np.random.default_rng(seed_seq)
+    followed, followers = sample_followers(rng, followed_ids, counts, num_users)
+
+    # shuffle, so the file isn't sorted by followed user
+    order = rng.permutation(len(followed))
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.writer(follows_csv)
+        follows_writer.writerow(FOLLOWS_CSV_HEADERS)
+        follows_writer.writerows(zip(followed[order].tolist(),
+                                     followers[order].tolist()))
+
+    return len(followed)
+
+
+def follower_counts(rng, num_users, num_follows):
+    """Followers per user id (index 0 is user 1), power-law distributed."""
+
+    cap = max(1, int((num_users - 1) * MAX_FOLLOWED_SHARE))
+    num_follows = min(num_follows, cap * num_users)
+
+    # popularity rank is independent of id
+    weights = np.empty(num_users)
+    weights[rng.permutation(num_users)] = power_law_weights(
+        num_users, FOLLOWED_EXPONENT)
+
+    counts = np.minimum(rng.multinomial(num_follows, weights / weights.sum()),
+                        cap)
+
+    # hand out what the cap cut off to users with room to spare
+    while counts.sum() < num_follows:
+        room = np.flatnonzero(counts < cap)
+        extra = rng.choice(room, size=min(len(room), num_follows - counts.sum()),
+                           replace=False)
+        counts[extra] += 1
+
+    return counts
+
+
+##############################################################################
+# Driver
+
+
+def generate(num_users, num_messages, num_follows, seed=0, shards=1,
+             out='generator', processes=None, until=None):
+    """Write users, messages and follows CSV shards into `out`.
+
+    Message timestamps fall in the two years before `until`, a naive UTC
+    datetime (default: midnight today, UTC).
+    """
+
+    if until is None:
+        until = datetime.combine(datetime.utcnow().date(), time())
+
+    os.makedirs(out, exist_ok=True)
+
+    root = np.random.SeedSequence(seed)
+    users_seq, messages_seq, follows_seq, counts_seq = root.spawn(4)
+    pool_seed = int(root.generate_state(1)[0])
+
+    counts = follower_counts(np.random.default_rng(counts_seq),
+                             num_users, num_follows)
+    user_ids = np.arange(1, num_users + 1)
+
+    jobs = []
+    for shard, (seq, (start, stop)) in enumerate(
+            zip(users_seq.spawn(shards), split(num_users, shards))):
+        jobs.append((write_users,
+                     (shard_path(out, 'users', shard, shards),
+                      start, stop, seq, pool_seed)))
+
+    for shard, (seq, (start, stop)) in enumerate(
+            zip(messages_seq.spawn(shards), split(num_messages, shards))):
+        jobs.append((write_messages,
+                     (shard_path(out, 'messages', shard, shards),
+                      stop - start, num_users, until, seq, pool_seed)))
+
+    # follows are sharded by followed user, so duplicates can only occur
+    # within a shard
+    for shard, (seq, (start, stop)) in enumerate(
+            zip(follows_seq.spawn(shards), split(num_users, shards))):
+        jobs.append((write_follows,
+                     (shard_path(out, 'follows', shard, shards),
+                      user_ids[start:stop], counts[start:stop],
+                      num_users, seq)))
+
+    with Pool(processes) as pool:
+        results = [pool.apply_async(func, args) for func, args in jobs]
+        written = [result.get() for result in results]
+
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--seed', type=int, default=0,
+                        help="same seed and arguments, same files")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="files per table, written in parallel")
+    parser.add_argument('--processes', type=int,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--out', default='generator',
+                        help="output directory")
+    parser.add_argument('--until', type=date.fromisoformat,
+                        help="latest message date (UTC), YYYY-MM-DD "
+                             "(default: today)")
+    args = parser.parse_args()
+
+    generate(args.users, args.messages, args.follows, args.seed,
+             args.shards, args.out, args.processes,
+             args.until and datetime.combine(args.until, time()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,27 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import numpy as np
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def random_timestamps(rng, count, until, year_gap=2):
+    """`count` random timestamp strings within a few years before `until`.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    `until` is a naive UTC datetime, like the timestamps the app stores.
+    Formatted like str(datetime), e.g. '2017-01-21 11:04:53.522807'.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    then = until.replace(year=until.year - year_gap)
+
+    # numpy treats naive datetimes as UTC, with no local-time conversion
+    micros = rng.integers(np.datetime64(then, 'us').astype(np.int64),
+                          np.datetime64(until, 'us').astype(np.int64),
+                          size=count)
+
+    stamps = np.datetime_as_string(micros.astype('datetime64[us]'))
+    return np.char.replace(stamps, 'T', ' ')
+
+
+def power_law_weights(count, exponent):
+    """Unnormalized weights 1/rank**exponent for ranks 1..count."""
+
+    return 1.0 / np.arange(1, count + 1) ** exponent
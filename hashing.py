@@ -0,0 +1,156 @@
+"""Password hashing and checking, off the request threads.
+
+bcrypt is deliberately slow, CPU-bound work that holds the GIL, so a burst
+of logins or signups would otherwise leave every request thread hashing.
+Instead hashes are worked out in a pool of HASH_WORKERS processes. At most
+HASH_MAX_PENDING jobs may be queued or running at once; a request that
+cannot get a slot within HASH_QUEUE_TIMEOUT seconds gets a 503 with
+Retry-After rather than piling on (backpressure). With HASH_WORKERS = 0
+hashing runs in the calling thread instead.
+
+New hashes use BCRYPT_LOG_ROUNDS. A hash made with any other cost still
+checks, and is replaced on the user's next successful login (see
+User.check_password), so changing the setting migrates users as they come
+back. The cost, queue depth and timings are reported in the metrics.
+"""
+
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+from instrumentation import metrics
+
+logger = logging.getLogger('warbler.hashing')
+
+DEFAULT_LOG_ROUNDS = 12
+
+# $2b$12$<salt and hash>: the cost is the second field
+_COST = re.compile(r'^\$2[abxy]?\$(\d{2})\$')
+
+
+class HashingBusy(Exception):
+    """Too many password hashes are already queued; try again shortly."""
+
+
+def _hash(password, log_rounds):
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(log_rounds)).decode('utf-8')
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def hash_cost(hashed):
+    """The log rounds `hashed` was made with (None if not a bcrypt hash)."""
+
+    match = _COST.match(hashed or '')
+    return match and int(match.group(1))
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded process pool (or inline, with no workers)."""
+
+    def __init__(self, log_rounds=DEFAULT_LOG_ROUNDS, workers=0,
+                 max_pending=None, queue_timeout=2.0):
+        self.configure(log_rounds, workers, max_pending, queue_timeout)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def configure(self, log_rounds, workers, max_pending=None,
+                  queue_timeout=2.0):
+        self.log_rounds = log_rounds
+        self.workers = workers
+        self.max_pending = max_pending or max(workers, 1) * 4
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+        metrics.gauge('hashing.log_rounds', log_rounds)
+        metrics.gauge('hashing.workers', workers)
+
+    def _executor(self):
+        # started on first use, so importing the app doesn't fork
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers)
+            return self._pool
+
+    def _count_pending(self, change):
+        with self._pending_lock:
+            self._pending += change
+            metrics.gauge('hashing.pending', self._pending)
+
+    def _run(self, kind, fn, *args):
+        started = time.perf_counter()
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            metrics.incr('hashing.rejected')
+            raise HashingBusy()
+
+        try:
+            self._count_pending(1)
+            metrics.observe('hashing.wait_ms',
+                            (time.perf_counter() - started) * 1000)
+
+            if self.workers:
+                result = self._executor().submit(fn, *args).result()
+            else:
+                result = fn(*args)
+
+        finally:
+            self._count_pending(-1)
+            self._slots.release()
+
+        metrics.observe(f"hashing.{kind}_ms",
+                        (time.perf_counter() - started) * 1000)
+        return result
+
+    def hash(self, password):
+        """A bcrypt hash of `password` at the configured cost."""
+
+        return self._run('hash', _hash, password, self.log_rounds)
+
+    def check(self, password, hashed):
+        """Does `password` match `hashed`?"""
+
+        return self._run('check', _check, password, hashed)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a cost other than the configured one?"""
+
+        return hash_cost(hashed) != self.log_rounds
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+hasher = PasswordHasher()
+
+
+def busy(error):
+    return ("Server busy, please try again in a moment.", 503,
+            {'Retry-After': '1'})
+
+
+def init_app(app):
+    """Configure the hasher from `app`'s config and answer HashingBusy."""
+
+    hasher.shutdown()
+    hasher.configure(app.config['BCRYPT_LOG_ROUNDS'],
+                     app.config['HASH_WORKERS'],
+                     app.config['HASH_MAX_PENDING'],
+                     app.config['HASH_QUEUE_TIMEOUT'])
+
+    logger.info("bcrypt cost %s, %s hashing worker(s)",
+                hasher.log_rounds, hasher.workers or 'no')
+
+    app.register_error_handler(HashingBusy, busy)
@@ -0,0 +1,255 @@
+"""Per-request SQL instrumentation for Warbler.
+
+SQLAlchemy engine events time every statement. While a request is being
+handled its queries are tallied, then reported as response headers and a
+log line, and folded into a rolling per-endpoint histogram. Tests can use
+the same machinery to put a budget on the number of queries a view runs.
+"""
+
+import heapq
+import logging
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from flask import g, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.requests')
+
+SLOWEST_KEPT = 3
+HISTORY_SIZE = 1000
+
+# Transaction bookkeeping (e.g. the savepoints tests run in) isn't a query.
+TRANSACTION_CONTROL = re.compile(r'\s*(BEGIN|SAVEPOINT|RELEASE|ROLLBACK TO)\b',
+                                 re.IGNORECASE)
+
+_local = threading.local()
+
+
+class QueryStats:
+    """Tally of the SQL statements run while this tracker was active."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+        self._slowest = []
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements.append(statement)
+
+        entry = (seconds, self.count, statement)
+        if len(self._slowest) < SLOWEST_KEPT:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    @property
+    def slowest(self):
+        """[(seconds, statement)] of the slowest statements, slowest first."""
+
+        return [(seconds, statement) for seconds, _, statement
+                in sorted(self._slowest, reverse=True)]
+
+
+def _active():
+    """Stack of trackers active on this thread."""
+
+    if not hasattr(_local, 'trackers'):
+        _local.trackers = []
+
+    return _local.trackers
+
+
+@contextmanager
+def count_queries():
+    """Track the queries run on this thread inside the `with` block."""
+
+    stats = QueryStats()
+    _active().append(stats)
+
+    try:
+        yield stats
+    finally:
+        _active().remove(stats)
+
+
+@contextmanager
+def query_budget(max_queries):
+    """Fail (AssertionError) if the block runs more than `max_queries`.
+
+    Meant for tests, to catch N+1 regressions from lazy relationships:
+
+        with query_budget(6):
+            client.get("/")
+    """
+
+    with count_queries() as stats:
+        yield stats
+
+    if stats.count > max_queries:
+        raise AssertionError(
+            f"{stats.count} queries run, over the budget of {max_queries}:\n"
+            + "\n".join(stats.statements))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+
+    if TRANSACTION_CONTROL.match(statement):
+        return
+
+    for stats in _active():
+        stats.record(statement, seconds)
+
+
+def _handle_error(context):
+    # a failed statement gets no after_cursor_execute; drop its start time
+    # so the next statement on this connection isn't timed from it (errors
+    # while connecting or fetching have no statement and pushed nothing)
+    if context.connection is not None and context.statement is not None:
+        started = context.connection.info.get('query_started')
+        if started:
+            started.pop()
+
+
+class RollingHistogram:
+    """The last `size` observations of a value, for percentile summaries."""
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.values = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.values.append(value)
+
+    def summary(self):
+        """Count and p50/p95/p99/max of the retained observations."""
+
+        with self.lock:
+            values = sorted(self.values)
+
+        if not values:
+            return {'count': 0}
+
+        def pct(p):
+            return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+        return {'count': len(values), 'p50': pct(50), 'p95': pct(95),
+                'p99': pct(99), 'max': values[-1]}
+
+
+class Metrics:
+    """Process-wide counters, gauges and rolling histograms, keyed by name."""
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = defaultdict(RollingHistogram)
+        self.lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def snapshot(self):
+        """All counters, gauges and histogram summaries as a JSON-able dict."""
+
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {name: histogram.summary()
+                           for name, histogram
+                           in sorted(self.histograms.items())},
+        }
+
+
+metrics = Metrics()
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.query_stats = QueryStats()
+    _active().append(g.query_stats)
+
+
+def _report_request(response):
+    stats = g.get('query_stats')
+    if stats is None:
+        return response
+
+    duration = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unknown'
+
+    metrics.observe(f"request.{endpoint}.ms", duration * 1000)
+    metrics.observe(f"request.{endpoint}.queries", stats.count)
+    metrics.observe(f"request.{endpoint}.sql_ms", stats.seconds * 1000)
+
+    response.headers['X-Query-Count'] = str(stats.count)
+    response.headers['X-Query-Time-Ms'] = f"{stats.seconds * 1000:.2f}"
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={stats.seconds * 1000:.2f};desc="{stats.count} queries"')
+
+    logger.info(
+        "method=%s path=%s endpoint=%s status=%s duration_ms=%.2f "
+        "queries=%d sql_ms=%.2f slowest=%r",
+        request.method, request.path, endpoint, response.status_code,
+        duration * 1000, stats.count, stats.seconds * 1000,
+        [f"{seconds * 1000:.2f}ms {statement}"
+         for seconds, statement in stats.slowest])
+
+    return response
+
+
+def _end_request(exc):
+    stats = g.pop('query_stats', None)
+    if stats in _active():
+        _active().remove(stats)
+
+
+def show_metrics():
+    """JSON dump of the in-process metrics."""
+
+    return jsonify(metrics.snapshot())
+
+
+def init_app(app):
+    """Instrument `app`'s requests and SQLAlchemy statements.
+
+    The metrics dump is served at /_metrics only if EXPOSE_METRICS is set.
+    """
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    app.before_request(_start_request)
+    app.after_request(_report_request)
+    app.teardown_request(_end_request)
+
+    if app.config.get('EXPOSE_METRICS'):
+        app.add_url_rule('/_metrics', 'show_metrics', show_metrics)
+
+    app.extensions['instrumentation'] = metrics
@@ -0,0 +1,357 @@
+"""Streaming bulk loader for Warbler CSV data.
+
+Loads users, messages and follows CSVs (as written by generator/, including
+sharded `messages-0003.csv`-style files) in fixed-size batches:
+
+- on PostgreSQL each batch is sent with COPY, elsewhere with executemany;
+- secondary indexes and foreign keys are dropped for the load and created
+  once at the end;
+- each batch is committed together with a checkpoint of the rows loaded
+  so far (kept in the database), so an interrupted load can be picked up
+  again with --resume;
+- rows of users and messages CSVs (which have no id column) are given ids
+  by their position, 1..N across a table's files in order, as the other
+  CSVs refer to them;
+- rows/second is reported per file and overall.
+
+Afterwards the denormalized counters and home timelines are rebuilt.
+
+    python loader.py --data-dir generator
+    python loader.py --data-dir /data/bench --batch-size 100000 --resume
+"""
+
+import argparse
+import csv
+import glob
+import io
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import BigInteger, Column, DDL, MetaData, Table, Text, inspect
+from sqlalchemy.schema import AddConstraint
+
+# the database is about to be rebuilt: skip indexing its usernames
+os.environ.setdefault('AUTOCOMPLETE_AT_STARTUP', '0')
+
+from app import app  # noqa: E402
+from feeds import rebuild_timelines  # noqa: E402
+from models import (db, User, Message, Follows, Likes, Timeline,  # noqa: E402
+                    USERNAME_TRGM_INDEX_DDL)
+
+# Tables loaded from CSV, in foreign key order.
+TABLES = [User.__table__, Message.__table__, Follows.__table__]
+
+# Tables not loaded from CSV, whose indexes are deferred too: timelines
+# are rebuilt from the loaded tables afterwards; likes aren't generated,
+# so they stay empty.
+DERIVED_TABLES = [Likes.__table__, Timeline.__table__]
+
+DEFAULT_BATCH_SIZE = 50000
+
+# Rows loaded per CSV file, in the database being loaded (outside the
+# app's metadata, so create_all/drop_all leave it alone).
+checkpoint_table = Table(
+    'load_checkpoint', MetaData(),
+    Column('name', Text, primary_key=True),
+    Column('rows', BigInteger, nullable=False),
+)
+
+
+class Checkpoint:
+    """Progress of a load, kept in the database next to the loaded rows.
+
+    Each batch's row count is updated in the batch's own transaction, so
+    the checkpoint can't fall behind (or run ahead of) what was loaded.
+    The table only exists once the schema is ready, until the load ends.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.schema_ready = False
+        self.rows = {}
+
+    def load(self):
+        if self.engine.has_table(checkpoint_table.name):
+            self.schema_ready = True
+            self.rows = {name: rows for name, rows
+                         in self.engine.execute(checkpoint_table.select())}
+
+    def start(self):
+        """Record that the schema is ready, with no rows loaded yet."""
+
+        checkpoint_table.drop(self.engine, checkfirst=True)
+        checkpoint_table.create(self.engine)
+        self.schema_ready = True
+        self.rows = {}
+
+    def rows_done(self, csv_path):
+        return self.rows.get(os.path.basename(csv_path), 0)
+
+    def add_rows(self, conn, csv_path, count):
+        """Count `count` more rows of `csv_path` as loaded, on `conn`."""
+
+        name = os.path.basename(csv_path)
+
+        if name in self.rows:
+            conn.execute(checkpoint_table.update()
+                         .where(checkpoint_table.c.name == name)
+                         .values(rows=checkpoint_table.c.rows + count))
+        else:
+            conn.execute(checkpoint_table.insert(), name=name, rows=count)
+
+        self.rows[name] = self.rows_done(csv_path) + count
+
+    def remove(self):
+        checkpoint_table.drop(self.engine, checkfirst=True)
+
+
+def is_postgresql(engine):
+    return engine.dialect.name == 'postgresql'
+
+
+def csv_files(data_dir, table):
+    """The CSV file(s) holding `table`: table.csv or table-NNNN.csv shards."""
+
+    return sorted(glob.glob(os.path.join(data_dir, f"{table.name}.csv"))
+                  + glob.glob(os.path.join(data_dir, f"{table.name}-*.csv")))
+
+
+def batches(rows, size):
+    """Split an iterator of rows into lists of at most `size`."""
+
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+##############################################################################
+# Deferred indexes and constraints
+
+
+def drop_deferred(engine, tables):
+    """Drop secondary indexes and foreign keys of `tables` before loading.
+
+    Primary keys and unique constraints stay, so bad data still fails
+    fast. SQLite can't drop constraints and doesn't enforce foreign keys
+    by default, so there only indexes are dropped.
+    """
+
+    if is_postgresql(engine):
+        inspector = inspect(engine)
+        for table in tables:
+            for fk in inspector.get_foreign_keys(table.name):
+                engine.execute(
+                    f'ALTER TABLE {table.name} DROP CONSTRAINT "{fk["name"]}"')
+
+        if User.__table__ in tables:
+            engine.execute("DROP INDEX IF EXISTS ix_users_username_trgm")
+
+    for table in tables:
+        for index in table.indexes:
+            index.drop(engine)
+
+
+def _foreign_key(columns, referred_table):
+    return (tuple(sorted(columns)), referred_table)
+
+
+def create_deferred(engine, tables):
+    """Recreate the indexes and foreign keys dropped by drop_deferred.
+
+    Ones that already exist (e.g. made before a resumed load was
+    interrupted) are skipped.
+    """
+
+    inspector = inspect(engine)
+
+    for table in tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+    if is_postgresql(engine):
+        for table in tables:
+            existing = {_foreign_key(fk['constrained_columns'],
+                                     fk['referred_table'])
+                        for fk in inspector.get_foreign_keys(table.name)}
+
+            for fk in table.foreign_key_constraints:
+                key = _foreign_key([column.name for column in fk.columns],
+                                   fk.referred_table.name)
+                if key not in existing:
+                    engine.execute(AddConstraint(fk))
+
+        if User.__table__ in tables:
+            existing = {index['name']
+                        for index in inspector.get_indexes(User.__table__.name)}
+            if 'ix_users_username_trgm' not in existing:
+                engine.execute(DDL(USERNAME_TRGM_INDEX_DDL))
+
+
+##############################################################################
+# Batch writers
+
+
+def copy_batch(conn, table, columns, batch):
+    """Send one batch with PostgreSQL COPY ... FROM STDIN."""
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(batch)
+    buf.seek(0)
+
+    # on the DBAPI connection under `conn`, so inside its transaction
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buf)
+
+
+def _converter(column):
+    """Turn a CSV string into a value for `column` (DBAPI executemany)."""
+
+    python_type = column.type.python_type
+
+    if python_type is datetime:
+        return lambda value: datetime.strptime(
+            value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+    if python_type is int:
+        return int
+
+    return str
+
+
+def insert_batch(conn, table, columns, batch):
+    """Send one batch as a single executemany INSERT."""
+
+    converters = [_converter(table.c[name]) for name in columns]
+    rows = [{name: (convert(value) if value != '' else None)
+             for name, convert, value in zip(columns, converters, row)}
+            for row in batch]
+
+    conn.execute(table.insert(), rows)
+
+
+##############################################################################
+# Loading
+
+
+def load_file(engine, table, path, checkpoint, batch_size, first_id=1):
+    """Stream one CSV into `table`, resuming after checkpointed rows.
+
+    If `table` has an id column the CSV doesn't, its rows get ids from
+    `first_id` on.
+    """
+
+    write_batch = copy_batch if is_postgresql(engine) else insert_batch
+    skip = checkpoint.rows_done(path)
+    loaded = 0
+    started = time.perf_counter()
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        rows = islice(reader, skip, None)
+
+        # not from the id sequence: a rolled-back batch still uses up its
+        # values, which would shift every id after a resume
+        if 'id' in table.c and 'id' not in columns:
+            columns = ['id', *columns]
+            rows = ([str(row_id), *row]
+                    for row_id, row in enumerate(rows, first_id + skip))
+
+        for batch in batches(rows, batch_size):
+            with engine.begin() as conn:
+                write_batch(conn, table, columns, batch)
+                checkpoint.add_rows(conn, path, len(batch))
+            loaded += len(batch)
+
+    elapsed = time.perf_counter() - started
+    print(f"{os.path.basename(path)}: {loaded} rows in {elapsed:.1f}s "
+          f"({loaded / elapsed if elapsed else 0:,.0f} rows/s)"
+          + (f", {skip} skipped as already loaded" if skip else ""))
+
+    return loaded
+
+
+def reset_sequences(engine, tables):
+    """Move `tables`' id sequences past the ids loaded (PostgreSQL)."""
+
+    if not is_postgresql(engine):
+        return
+
+    for table in tables:
+        if 'id' in table.c:
+            engine.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table.name}")
+
+
+def load(data_dir, batch_size=DEFAULT_BATCH_SIZE, resume=False):
+    """Load every CSV in `data_dir` into a fresh (or resumed) database."""
+
+    engine = db.engine
+    checkpoint = Checkpoint(engine)
+
+    if resume:
+        checkpoint.load()
+
+    if not checkpoint.schema_ready:
+        db.drop_all()
+        db.create_all()
+        drop_deferred(engine, TABLES + DERIVED_TABLES)
+        checkpoint.start()
+
+    started = time.perf_counter()
+    total = 0
+
+    for table in TABLES:
+        first_id = 1
+        for path in csv_files(data_dir, table):
+            total += load_file(engine, table, path, checkpoint, batch_size,
+                               first_id)
+            first_id += checkpoint.rows_done(path)
+
+    reset_sequences(engine, TABLES)
+
+    elapsed = time.perf_counter() - started
+    print(f"loaded {total} rows in {elapsed:.1f}s "
+          f"({total / elapsed if elapsed else 0:,.0f} rows/s)")
+
+    # the counters and timelines are computed with the source tables'
+    # indexes in place, then the derived tables get theirs
+    step = time.perf_counter()
+    create_deferred(engine, TABLES)
+    print(f"indexes and constraints: {time.perf_counter() - step:.1f}s")
+
+    step = time.perf_counter()
+    User.recount()
+    Message.recount()
+    rebuild_timelines(app.config['FEED_FANOUT_THRESHOLD'])
+    db.session.commit()
+    create_deferred(engine, DERIVED_TABLES)
+    print(f"counters and timelines: {time.perf_counter() - step:.1f}s")
+
+    checkpoint.remove()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory of users/messages/follows CSVs")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="rows per COPY/executemany batch")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted load from its checkpoint")
+    args = parser.parse_args()
+
+    load(args.data_dir, args.batch_size, args.resume)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Follow and like membership checks for the logged-in user.
+
+Templates ask "does the current user follow this user / like this message?"
+once per rendered card or message. Rather than scanning `g.user.following`
+or `g.user.likes` each time, the ids are loaded once per request into sets.
+"""
+
+from models import db, Follows, Likes
+
+
+def _id(obj):
+    """Accept either a model instance or a bare id."""
+
+    return getattr(obj, 'id', obj)
+
+
+class Membership:
+    """The current user's followed user ids and liked message ids.
+
+    Each set is loaded lazily with one id-only query the first time it is
+    needed, unless already-known sets (e.g. from a cache) are passed in.
+    An anonymous viewer (user_id None) follows and likes nothing.
+    """
+
+    def __init__(self, user_id, following_ids=None, liked_ids=None):
+        self.user_id = user_id
+        self._following_ids = following_ids
+        self._liked_ids = liked_ids
+
+    @property
+    def following_ids(self):
+        """Set of ids of the users this user follows."""
+
+        if self._following_ids is None:
+            self._following_ids = self._load(
+                Follows.user_being_followed_id,
+                Follows.user_following_id)
+
+        return self._following_ids
+
+    @property
+    def liked_ids(self):
+        """Set of ids of the messages this user has liked."""
+
+        if self._liked_ids is None:
+            self._liked_ids = self._load(Likes.message_id, Likes.user_id)
+
+        return self._liked_ids
+
+    def _load(self, id_col, owner_col):
+        if self.user_id is None:
+            return set()
+
+        return {id for (id,) in db.session.query(id_col)
+                .filter(owner_col == self.user_id)}
+
+    def loaded(self):
+        """The sets loaded so far, as keyword arguments for __init__."""
+
+        loaded = {}
+        if self._following_ids is not None:
+            loaded['following_ids'] = self._following_ids
+        if self._liked_ids is not None:
+            loaded['liked_ids'] = self._liked_ids
+
+        return loaded
+
+    def is_following(self, user):
+        """Does the current user follow `user` (instance or id)?"""
+
+        return _id(user) in self.following_ids
+
+    def has_liked(self, message):
+        """Has the current user liked `message` (instance or id)?"""
+
+        return _id(message) in self.liked_ids
+
+    # The methods below keep already-loaded sets in step with the write
+    # paths in app.py; sets not loaded yet will be read fresh anyway.
+
+    def followed(self, user):
+        """Record that the current user now follows `user`."""
+
+        if self._following_ids is not None:
+            self._following_ids.add(_id(user))
+
+    def unfollowed(self, user):
+        """Record that the current user no longer follows `user`."""
+
+        if self._following_ids is not None:
+            self._following_ids.discard(_id(user))
+
+    def liked(self, message):
+        """Record that the current user now likes `message`."""
+
+        if self._liked_ids is not None:
+            self._liked_ids.add(_id(message))
+
+    def unliked(self, message):
+        """Record that the current user no longer likes `message`."""
+
+        if self._liked_ids is not None:
+            self._liked_ids.discard(_id(message))
@@ -0,0 +1,57 @@
+-- Home timelines, denormalized user counters and username search.
+--
+-- For databases created from the original schema; new ones get this schema
+-- from db.create_all(). Run before the other migrations, with:
+-- psql warbler -f migrations/0000_timelines_counters_search.sql
+
+BEGIN;
+
+-- users: per-user counts shown on every profile and user card
+ALTER TABLE users ADD COLUMN IF NOT EXISTS messages_count integer NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS following_count integer NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS followers_count integer NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS likes_count integer NOT NULL DEFAULT 0;
+
+UPDATE users
+SET messages_count = (SELECT count(*) FROM messages
+                      WHERE messages.user_id = users.id),
+    following_count = (SELECT count(*) FROM follows
+                       WHERE follows.user_following_id = users.id),
+    followers_count = (SELECT count(*) FROM follows
+                       WHERE follows.user_being_followed_id = users.id),
+    likes_count = (SELECT count(*) FROM likes
+                   WHERE likes.user_id = users.id);
+
+-- timelines: each user's precomputed home feed (see feeds.py)
+CREATE TABLE IF NOT EXISTS timelines (
+    owner_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id integer NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    timestamp timestamp without time zone NOT NULL,
+    PRIMARY KEY (owner_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_timelines_owner_id_timestamp_message_id
+    ON timelines (owner_id, timestamp DESC, message_id DESC);
+
+-- as feeds.rebuild_timelines(): everyone's own messages, plus those of
+-- the authors they follow, except authors above the default
+-- FEED_FANOUT_THRESHOLD (10000 followers), whose messages are pulled
+INSERT INTO timelines (owner_id, message_id, timestamp)
+SELECT user_id, id, timestamp FROM messages
+ON CONFLICT DO NOTHING;
+
+INSERT INTO timelines (owner_id, message_id, timestamp)
+SELECT follows.user_following_id, messages.id, messages.timestamp
+FROM follows
+JOIN messages ON messages.user_id = follows.user_being_followed_id
+JOIN users ON users.id = follows.user_being_followed_id
+WHERE users.followers_count <= 10000
+ON CONFLICT DO NOTHING;
+
+-- users: trigram index for username search (see search.py)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+    ON users USING gin (username gin_trgm_ops);
+
+COMMIT;
@@ -0,0 +1,33 @@
+-- Likes keyed by (user_id, message_id), with per-message like counts.
+--
+-- For databases created before these changes; new ones get this schema from
+-- db.create_all(). Run with: psql warbler -f migrations/0001_likes_primary_key.sql
+
+BEGIN;
+
+-- likes: the surrogate id and the unique message_id (which let only one
+-- user ever like a message) give way to a composite primary key
+DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL;
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key;
+ALTER TABLE likes DROP CONSTRAINT likes_pkey;
+ALTER TABLE likes DROP COLUMN id;
+ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id);
+
+CREATE INDEX ix_likes_message_id_user_id ON likes (message_id, user_id);
+
+-- messages: denormalized like counts
+ALTER TABLE messages ADD COLUMN likes_count integer NOT NULL DEFAULT 0;
+
+UPDATE messages
+SET likes_count = counts.likes
+FROM (SELECT message_id, count(*) AS likes
+      FROM likes
+      GROUP BY message_id) AS counts
+WHERE messages.id = counts.message_id;
+
+-- follows: the "followed by" index from the paginated following page
+CREATE INDEX IF NOT EXISTS ix_follows_user_following_id_user_being_followed_id
+    ON follows (user_following_id, user_being_followed_id);
+
+COMMIT;
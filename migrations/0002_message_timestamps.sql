@@ -0,0 +1,20 @@
+-- Message timestamps set by the database, and newest-first indexes.
+--
+-- For databases created before these changes; new ones get this schema from
+-- db.create_all(). Run with: psql warbler -f migrations/0002_message_timestamps.sql
+
+BEGIN;
+
+-- was a fixed value worked out in Python when the app started
+ALTER TABLE messages
+    ALTER COLUMN timestamp SET DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP);
+
+-- one author's messages, newest first (profile pages, pulled authors)
+CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp_id
+    ON messages (user_id, timestamp DESC, id DESC);
+
+-- everyone's messages, newest first
+CREATE INDEX IF NOT EXISTS ix_messages_timestamp_id
+    ON messages (timestamp DESC, id DESC);
+
+COMMIT;
@@ -0,0 +1,14 @@
+-- Stored push/pull mode of each author's home feed delivery.
+--
+-- For databases created before this change; new ones get this schema from
+-- db.create_all(). Run with: psql warbler -f migrations/0003_users_feed_pulled.sql
+
+BEGIN;
+
+ALTER TABLE users ADD COLUMN feed_pulled boolean NOT NULL DEFAULT false;
+
+-- the authors above the default FEED_FANOUT_THRESHOLD (10000 followers),
+-- which is what decided this until now
+UPDATE users SET feed_pulled = true WHERE followers_count > 10000;
+
+COMMIT;
@@ -1,14 +1,40 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
-
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, DateTime, case, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.sql.expression import FunctionElement
+
+from hashing import hasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+class utcnow(FunctionElement):
+    """The database's current time in UTC, as a naive timestamp."""
+
+    type = DateTime()
+
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow, 'sqlite')
+def _utcnow_sqlite(element, compiler, **kw):
+    # with microseconds, in the format SQLAlchemy stores datetimes in;
+    # parenthesized, as SQLite only takes an expression DEFAULT that way
+    return "(STRFTIME('%Y-%m-%d %H:%M:%f000', 'now'))"
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -26,28 +52,96 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key serves "followers of"; this serves "followed by"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id_user_being_followed_id',
+                 user_following_id, user_being_followed_id),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        return db.session.query(
+            cls.query
+            .filter(cls.user_following_id == follower_id,
+                    cls.user_being_followed_id == followed_id)
+            .exists()
+        ).scalar()
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id`, adjusting both counters.
+
+        Idempotent: returns False, changing nothing, if already following.
+        """
+
+        return _write_counted(
+            _insert_ignore(cls.__table__, user_following_id=follower_id,
+                           user_being_followed_id=followed_id),
+            [(cls.user_following_id, follower_id, User.following_count, 1),
+             (cls.user_being_followed_id, followed_id, User.followers_count,
+              1)])
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Undo add(); returns False if `follower_id` wasn't following."""
+
+        return _write_counted(
+            cls.__table__.delete()
+            .where(cls.user_following_id == follower_id)
+            .where(cls.user_being_followed_id == followed_id),
+            [(cls.user_following_id, follower_id, User.following_count, -1),
+             (cls.user_being_followed_id, followed_id, User.followers_count,
+              -1)])
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
-
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
+    # the primary key serves "liked by user"; this serves "likers of"
+    __table_args__ = (
+        db.Index('ix_likes_message_id_user_id', message_id, user_id),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Record that `user_id` likes `message_id`, adjusting the counters.
+
+        Idempotent: returns False, changing nothing, if already liked.
+        """
+
+        return _write_counted(
+            _insert_ignore(cls.__table__, user_id=user_id,
+                           message_id=message_id),
+            [(cls.user_id, user_id, User.likes_count, 1),
+             (cls.message_id, message_id, Message.likes_count, 1)])
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Undo add(); returns False if `user_id` didn't like it."""
+
+        return _write_counted(
+            cls.__table__.delete()
+            .where(cls.user_id == user_id)
+            .where(cls.message_id == message_id),
+            [(cls.user_id, user_id, User.likes_count, -1),
+             (cls.message_id, message_id, Message.likes_count, -1)])
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,7 +188,51 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts of the relationships below, kept in step by the
+    # write paths in app.py (see adjust_counts) and repaired by recount().
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Are this user's messages pulled into followers' home feeds at read
+    # time rather than pushed to their timelines? Switched by
+    # feeds.followers_changed() as the follower count moves.
+    feed_pulled = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # messages.user_id is ON DELETE CASCADE; leave unloaded messages (and
+    # their likes and timeline entries) to the database
+    messages = db.relationship('Message', cascade='all, delete-orphan',
+                               passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -118,17 +256,87 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    # What pages show of a user; email and password hash are left out of
+    # snapshots and loaded on demand.
+    SNAPSHOT_COLUMNS = ('id', 'username', 'image_url', 'header_image_url',
+                        'bio', 'location', 'messages_count', 'following_count',
+                        'followers_count', 'likes_count')
+
+    def snapshot(self):
+        """The shown column values of this user, as a plain dict for caching."""
+
+        return {key: getattr(self, key) for key in self.SNAPSHOT_COLUMNS}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Rebuild a session-attached user from `snapshot()` without a query.
+
+        Relationships, and columns left out of the snapshot, are still
+        loaded lazily from the database on access.
+        """
+
+        user = cls(**snapshot)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+        """Is this user followed by `other_user`?
+
+        Checks the single follows row rather than loading all followers.
+        For many checks in one request, see membership.Membership.
+        """
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counters of `user_ids`.
+
+        `user_ids` is a single id, a list of ids or a select of ids; the
+        update is done in SQL (e.g. likes_count = likes_count + 1) so it
+        is atomic and part of the caller's transaction.
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        (cls
+         .query
+         .filter(cls.id.in_(user_ids))
+         .update({getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()},
+                 synchronize_session=False))
+
+    @classmethod
+    def recount(cls, user_ids=None):
+        """Recompute counters from the messages, follows and likes tables.
+
+        Repairs every user, or only `user_ids` if given.
+        """
+
+        def count(table, column):
+            return (db.select([db.func.count()])
+                    .select_from(table)
+                    .where(column == cls.id)
+                    .as_scalar())
+
+        query = cls.query
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+
+        query.update({
+            cls.messages_count: count(Message.__table__, Message.user_id),
+            cls.following_count: count(Follows.__table__,
+                                       Follows.user_following_id),
+            cls.followers_count: count(Follows.__table__,
+                                       Follows.user_being_followed_id),
+            cls.likes_count: count(Likes.__table__, Likes.user_id),
+        }, synchronize_session=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +345,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -162,13 +370,114 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Is `password` this user's password?
+
+        If it is, but the stored hash was made at an outdated cost, the hash
+        is replaced with one at the current cost (committed by the caller).
+        """
+
+        if not hasher.check(password, self.password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+
+        return True
+
+
+def _insert_ignore(table, **row):
+    """INSERT of `row` that does nothing if it conflicts with an existing row."""
+
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(table).values(row).on_conflict_do_nothing()
+
+    return (table.insert().values(row)
+            .prefix_with('OR IGNORE', dialect='sqlite')
+            .prefix_with('IGNORE', dialect='mysql'))
+
+
+def _write_counted(change, counters):
+    """Run `change`, adjusting counter columns if it changed a row.
+
+    `change` inserts or deletes a single association row. `counters` lists
+    (column of that row, the id it holds, counter column of the table that
+    id refers to, delta), e.g. (Likes.user_id, 3, User.likes_count, 1). On
+    PostgreSQL the write and the counter updates are one statement (the
+    change in a CTE feeding an UPDATE per counted table), so a follow or
+    like is a single round trip; elsewhere the counters are updated after
+    it. Either way it is all in the caller's transaction.
+
+    Returns whether a row was inserted or deleted.
+    """
+
+    # pending ORM changes go first (a no-op, without a round trip, if none)
+    db.session.flush()
+
+    if db.engine.dialect.name != 'postgresql':
+        if not db.session.execute(change).rowcount:
+            return False
+
+        for _, row_id, counter, delta in counters:
+            model = counter.class_
+            (model.query
+             .filter(model.id == row_id)
+             .update({counter: counter + delta},
+                     synchronize_session=False))
+        return True
+
+    columns = list({column.key: column for column, *_ in counters}.values())
+    changed = change.returning(*columns).cte('changed')
+
+    by_table = {}
+    for column, _, counter, delta in counters:
+        by_table.setdefault(counter.class_.__table__, []).append(
+            (changed.c[column.key], counter.key, delta))
+
+    counted = []
+    for table, updates in by_table.items():
+        update = (table.update()
+                  .values({name: table.c[name] + case(
+                               [(table.c.id == changed_id, delta)], else_=0)
+                           for changed_id, name, delta in updates})
+                  .where(table.c.id.in_([changed_id
+                                         for changed_id, *_ in updates]))
+                  .returning(table.c.id))
+        counted.append(update.cte(f"{table.name}_counted"))
+
+    def count(cte):
+        return db.select([db.func.count()]).select_from(cte).as_scalar()
+
+    # SQLAlchemy only renders the CTEs this SELECT refers to, hence the
+    # counts of the UPDATEs; PostgreSQL then runs every data-modifying
+    # CTE in the WITH, whether or not its result is read
+    row = db.session.execute(
+        db.select([count(changed)] + [count(cte) for cte in counted])).first()
+
+    return row[0] > 0
+
+
+# Trigram index backing username search (see search.py). PostgreSQL only;
+# other databases use search.py's in-memory fallback.
+USERNAME_TRGM_INDEX_DDL = ("CREATE INDEX ix_users_username_trgm "
+                           "ON users USING gin (username gin_trgm_ops)")
+
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'),
+)
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL(USERNAME_TRGM_INDEX_DDL).execute_if(dialect='postgresql'),
+)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -185,10 +494,13 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Set by the database when the row is inserted. Messages posted in the
+    # same instant are told apart by id, which only grows, so (timestamp,
+    # id) orders every listing.
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -197,8 +509,80 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized number of likes, kept in step by Likes.add/remove and
+    # repaired by recount().
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    # newest-first ranges of one author's messages, and of everyone's
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp_id',
+                 user_id, timestamp.desc(), id.desc()),
+        db.Index('ix_messages_timestamp_id',
+                 timestamp.desc(), id.desc()),
+    )
+
+    # read the timestamp back in the INSERT (RETURNING on PostgreSQL), as
+    # the fan-out to timelines needs it straight away
+    __mapper_args__ = {'eager_defaults': True}
+
+
+    @classmethod
+    def recount(cls, message_ids=None):
+        """Recompute like counts from the likes table.
+
+        Repairs every message, or only `message_ids` if given.
+        """
+
+        likes = (db.select([db.func.count()])
+                 .select_from(Likes.__table__)
+                 .where(Likes.message_id == cls.id)
+                 .as_scalar())
+
+        query = cls.query
+        if message_ids is not None:
+            query = query.filter(cls.id.in_(message_ids))
+
+        query.update({cls.likes_count: likes}, synchronize_session=False)
+
+
+class Timeline(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write) so the
+    home page can read one indexed range instead of joining follows.
+    """
+
+    __tablename__ = 'timelines'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_owner_id_timestamp_message_id',
+                 owner_id, timestamp.desc(), message_id.desc()),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,131 @@
+"""Keyset (cursor) pagination for message and user listings.
+
+Message pages are walked newest-first by (timestamp, id). Instead of an
+OFFSET, the next page is requested with an opaque `before` cursor naming
+the last row seen, so page 50 costs the same index range scan as page 1.
+User lists (followers, following) are walked by id with an `after` id.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort, request
+from sqlalchemy import tuple_
+
+PER_PAGE = 20
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(timestamp, id):
+    """Build an opaque cursor token from a (timestamp, id) sort key."""
+
+    raw = f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}|{id}"
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Turn a cursor token back into a (timestamp, id) sort key.
+
+    Returns None for a missing token; a malformed one is a 400.
+    """
+
+    if not token:
+        return None
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return (datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id))
+
+    except (Base64Error, UnicodeError, ValueError):
+        abort(400)
+
+
+def request_cursor():
+    """The (timestamp, id) cursor passed as ?before= on this request."""
+
+    return decode_cursor(request.args.get('before'))
+
+
+def keyset(query, timestamp_col, id_col, before=None, per_page=PER_PAGE):
+    """Restrict `query` to one page of rows older than `before`.
+
+    With no `timestamp_col` the rows are walked by `id_col` alone, for a
+    listing whose index ends in a message id (ids grow with timestamps),
+    and only the id of `before` is used.
+
+    One extra row is fetched so `page_of` can tell if there is a next page.
+    """
+
+    if timestamp_col is None:
+        if before is not None:
+            query = query.filter(id_col < before[1])
+
+        return query.order_by(id_col.desc()).limit(per_page + 1)
+
+    if before is not None:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*before))
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1))
+
+
+def page_of(messages, per_page=PER_PAGE):
+    """Wrap up to `per_page` + 1 newest-first messages as a Page."""
+
+    if len(messages) <= per_page:
+        return Page(messages, None)
+
+    messages = messages[:per_page]
+    last = messages[-1]
+    return Page(messages, encode_cursor(last.timestamp, last.id))
+
+
+def paginate(query, timestamp_col, id_col, before=None, per_page=PER_PAGE,
+             fetch=None):
+    """Run a keyset-paginated message query, returning a Page.
+
+    `fetch` runs the final query; it defaults to Query.all().
+    """
+
+    query = keyset(query, timestamp_col, id_col, before, per_page)
+
+    return page_of(fetch(query) if fetch else query.all(), per_page)
+
+
+class IdPage:
+    """One page of a query's rows in id order, after id `after`.
+
+    The query only runs when the page is first iterated, so a streamed
+    template (see streaming.py) sends everything above the list first.
+    Once iterated, `next_after` is the id to continue after, or None on
+    the last page.
+    """
+
+    def __init__(self, query, id_col, after=None, per_page=PER_PAGE):
+        if after is not None:
+            query = query.filter(id_col > after)
+
+        self.query = query.order_by(id_col).limit(per_page + 1)
+        self.per_page = per_page
+        self.next_after = None
+        self._items = None
+
+    def __iter__(self):
+        if self._items is None:
+            items = self.query.all()
+
+            if len(items) > self.per_page:
+                items = items[:self.per_page]
+                self.next_after = items[-1].id
+
+            self._items = items
+
+        return iter(self._items)
@@ -0,0 +1,106 @@
+"""Query-plan checks for the message feeds.
+
+Profile pages, pulled authors, home timelines and likes are all read
+newest-first a page at a time, which is only cheap if the database walks
+an index on (..., timestamp DESC, id DESC), or for likes the likes key
+(user_id, message_id), and stops after one page. check_feed_plans()
+EXPLAINs each feed query, first page and a later one, and reports any plan
+that reads a whole table or sorts its rows instead.
+
+On PostgreSQL sequential scans and sorts are disabled while explaining, so
+a small or freshly loaded database (where a seq scan really is cheapest)
+still shows whether the index *can* serve the query. `flask check-plans`
+runs the check against the configured database.
+"""
+
+import re
+from datetime import datetime
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from feeds import author_messages, liked_messages, timeline_messages
+from models import db, Likes, Message, Timeline
+from pagination import keyset
+
+# plan lines that mean a message listing isn't a bounded index range
+FULL_SCANS = {
+    'postgresql': re.compile(r'Seq Scan on (messages|timelines|likes)\b'
+                             r'|^\s*(->\s*)?(Incremental )?Sort\b'),
+    'sqlite': re.compile(r'^SCAN (TABLE )?(messages|timelines|likes)\b(?!.*INDEX)'
+                         r'|USE TEMP B-TREE FOR ORDER BY'),
+}
+
+
+class explain(Executable, ClauseElement):
+    """EXPLAIN (EXPLAIN QUERY PLAN on SQLite) a SELECT."""
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(explain)
+def _explain(element, compiler, **kw):
+    return "EXPLAIN " + compiler.process(element.statement, **kw)
+
+
+@compiles(explain, 'sqlite')
+def _explain_sqlite(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement, **kw)
+
+
+def feed_queries(user_id):
+    """The feed queries to check, by name, as `user_id` would run them."""
+
+    before = (datetime.utcnow(), 0)
+    queries = {}
+
+    for page, cursor in (('first page', None), ('later page', before)):
+        queries[f"profile, {page}"] = keyset(
+            author_messages(user_id),
+            Message.timestamp, Message.id, cursor)
+        queries[f"timeline, {page}"] = keyset(
+            timeline_messages(user_id),
+            Timeline.timestamp, Timeline.message_id, cursor)
+        queries[f"likes, {page}"] = keyset(
+            liked_messages(user_id), None, Likes.message_id, cursor)
+
+    return queries
+
+
+def query_plan(query):
+    """The lines of the database's plan for `query`."""
+
+    dialect = db.session.get_bind().dialect.name
+    savepoint = db.session.begin_nested()
+
+    try:
+        if dialect == 'postgresql':
+            # undone with the savepoint
+            db.session.execute("SET LOCAL enable_seqscan = off")
+            db.session.execute("SET LOCAL enable_sort = off")
+
+        rows = db.session.execute(explain(query.statement)).fetchall()
+
+    finally:
+        savepoint.rollback()
+
+    # the plan text is the last column (SQLite adds ids before it)
+    return [row[-1] for row in rows]
+
+
+def check_feed_plans(user_id):
+    """EXPLAIN every feed query; {name: (plan lines, offending lines)}."""
+
+    dialect = db.session.get_bind().dialect.name
+    full_scan = FULL_SCANS.get(dialect)
+
+    if full_scan is None:
+        raise ValueError(f"No plan check for {dialect} databases")
+
+    results = {}
+    for name, query in feed_queries(user_id).items():
+        plan = query_plan(query)
+        results[name] = (plan, [line for line in plan if full_scan.search(line)])
+
+    return results
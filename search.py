@@ -0,0 +1,336 @@
+"""Username search for the /users directory.
+
+On PostgreSQL, searches use a pg_trgm GIN index on users.username (created
+with the table, see models.py), so substring matches do not scan the whole
+table. Other databases (SQLite, in tests) fall back to an in-memory trigram
+index. Either way results are ranked (prefix matches first, then by
+similarity) and capped at SEARCH_RESULT_LIMIT.
+
+As-you-type autocomplete is served entirely from memory by a sorted
+PrefixIndex of usernames, built at startup and kept current by the
+signup, rename and delete views through the user_* hooks at the bottom.
+"""
+
+import logging
+import sys
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+from sqlalchemy import case, func
+from sqlalchemy.exc import SQLAlchemyError
+
+from instrumentation import metrics
+from models import db, User
+
+logger = logging.getLogger('warbler.search')
+
+USERS_PER_PAGE = 24
+SEARCH_RESULT_LIMIT = 120
+
+
+def trigrams(text, padded=True):
+    """The set of 3-character substrings of lower-cased `text`.
+
+    Padded like pg_trgm, so word starts and ends form their own grams.
+    """
+
+    text = text.lower()
+    if padded:
+        text = f"  {text} "
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in user input (with '\\' as escape char)."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+class NgramIndex:
+    """In-memory trigram index of usernames.
+
+    Maps each trigram to the ids of usernames containing it, so a search
+    only looks at usernames sharing every trigram of the query.
+    """
+
+    def __init__(self):
+        self.usernames = {}
+        self.postings = defaultdict(set)
+        self.stamp = None
+        self.lock = threading.Lock()
+
+    def add(self, user_id, username):
+        with self.lock:
+            self._remove(user_id)
+            self.usernames[user_id] = username
+            for gram in trigrams(username):
+                self.postings[gram].add(user_id)
+
+    def remove(self, user_id):
+        with self.lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        username = self.usernames.pop(user_id, None)
+        if username is None:
+            return
+
+        for gram in trigrams(username):
+            self.postings[gram].discard(user_id)
+            if not self.postings[gram]:
+                del self.postings[gram]
+
+    def load(self, rows, stamp=None):
+        """Replace the contents with (id, username) `rows`."""
+
+        with self.lock:
+            self.usernames = {}
+            self.postings = defaultdict(set)
+            self.stamp = stamp
+
+        for user_id, username in rows:
+            self.add(user_id, username)
+
+    def search(self, query, limit):
+        """Ids of usernames containing `query`, best matches first."""
+
+        needle = query.lower()
+        grams = trigrams(needle, padded=False)
+
+        with self.lock:
+            if grams:
+                candidates = set.intersection(
+                    *(self.postings.get(gram, set()) for gram in grams))
+            else:
+                candidates = set(self.usernames)
+
+            matches = [(user_id, self.usernames[user_id])
+                       for user_id in candidates
+                       if needle in self.usernames[user_id].lower()]
+
+        query_grams = trigrams(needle)
+
+        def rank(match):
+            user_id, username = match
+            grams = trigrams(username)
+            similarity = len(grams & query_grams) / len(grams | query_grams)
+            return (not username.lower().startswith(needle),
+                    -similarity, username)
+
+        return [user_id for user_id, _ in sorted(matches, key=rank)[:limit]]
+
+
+class PrefixIndex:
+    """Sorted in-memory array of usernames for prefix lookups.
+
+    Entries are (lower-cased username, username, id) tuples kept in sorted
+    order, so all names starting with a prefix are a contiguous run found
+    by binary search.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.keys = {}
+        self.nbytes = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(entry):
+        return sys.getsizeof(entry) + sum(sys.getsizeof(part) for part in entry)
+
+    def load(self, rows):
+        """Replace the contents with (id, username) `rows`."""
+
+        entries = sorted((username.lower(), username, user_id)
+                         for user_id, username in rows)
+
+        with self.lock:
+            self.entries = entries
+            self.keys = {entry[2]: entry for entry in entries}
+            self.nbytes = sum(self._sizeof(entry) for entry in entries)
+            self.loaded = True
+
+        self._report()
+
+    def add(self, user_id, username):
+        with self.lock:
+            self._remove(user_id)
+            entry = (username.lower(), username, user_id)
+            insort(self.entries, entry)
+            self.keys[user_id] = entry
+            self.nbytes += self._sizeof(entry)
+
+        self._report()
+
+    def remove(self, user_id):
+        with self.lock:
+            self._remove(user_id)
+
+        self._report()
+
+    def _remove(self, user_id):
+        entry = self.keys.pop(user_id, None)
+        if entry is None:
+            return
+
+        del self.entries[bisect_left(self.entries, entry)]
+        self.nbytes -= self._sizeof(entry)
+
+    def complete(self, prefix, limit=10):
+        """Up to `limit` (id, username) pairs whose name starts with `prefix`."""
+
+        prefix = prefix.lower()
+        results = []
+
+        with self.lock:
+            i = bisect_left(self.entries, (prefix,))
+            while (len(results) < limit and i < len(self.entries)
+                   and self.entries[i][0].startswith(prefix)):
+                results.append((self.entries[i][2], self.entries[i][1]))
+                i += 1
+
+        return results
+
+    def memory_usage(self):
+        """Approximate bytes held: the array, its entries and the id map."""
+
+        return (self.nbytes + sys.getsizeof(self.entries)
+                + sys.getsizeof(self.keys))
+
+    def _report(self):
+        metrics.gauge('autocomplete.entries', len(self.entries))
+        metrics.gauge('autocomplete.bytes', self.memory_usage())
+
+
+fallback_index = NgramIndex()
+autocomplete_index = PrefixIndex()
+
+
+def build_autocomplete_index():
+    """Load every username into the autocomplete index."""
+
+    autocomplete_index.load(db.session.query(User.id, User.username))
+    logger.info("autocomplete index built: %d usernames, %d bytes",
+                len(autocomplete_index.entries),
+                autocomplete_index.memory_usage())
+
+
+def init_app(app):
+    """Build the autocomplete index now if AUTOCOMPLETE_AT_STARTUP is set.
+
+    Without the index autocomplete finds nothing, so a process that serves
+    requests should build it before taking any.
+    """
+
+    if not app.config['AUTOCOMPLETE_AT_STARTUP']:
+        return
+
+    with app.app_context():
+        try:
+            build_autocomplete_index()
+        except SQLAlchemyError as error:
+            # e.g. a database whose tables haven't been created yet
+            logger.warning("autocomplete index not built: %s", error)
+        finally:
+            db.session.remove()
+
+
+def _uses_trigram_index():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _search_postgresql(query, offset, limit):
+    lowered = query.lower()
+    pattern = f"%{escape_like(query)}%"
+
+    return (User
+            .query
+            .filter(User.username.ilike(pattern, escape='\\'))
+            .order_by(
+                case([(func.lower(User.username)
+                       .startswith(lowered, autoescape=True), 0)],
+                     else_=1),
+                func.similarity(User.username, query).desc(),
+                User.username)
+            .offset(offset)
+            .limit(limit)
+            .all())
+
+
+def _search_fallback(query, offset, limit):
+    # cheap staleness check, so rows added or removed behind our back
+    # (e.g. directly in tests) are picked up
+    stamp = tuple(db.session
+                  .query(func.count(User.id), func.max(User.id))
+                  .one())
+    if stamp != fallback_index.stamp:
+        fallback_index.load(db.session.query(User.id, User.username),
+                            stamp=stamp)
+
+    ids = fallback_index.search(query, offset + limit)[offset:]
+    users = {user.id: user
+             for user in User.query.filter(User.id.in_(ids))} if ids else {}
+
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+def search_users(query, page=1, per_page=USERS_PER_PAGE):
+    """One page of users whose username contains `query`, ranked.
+
+    Returns (users, has_next). Results beyond SEARCH_RESULT_LIMIT are
+    never returned, however far the caller pages.
+    """
+
+    offset = (page - 1) * per_page
+    limit = min(per_page + 1, SEARCH_RESULT_LIMIT - offset)
+
+    if limit <= 0:
+        return [], False
+
+    search = (_search_postgresql if _uses_trigram_index()
+              else _search_fallback)
+    users = search(query, offset, limit)
+
+    return users[:per_page], len(users) > per_page
+
+
+def directory_page(after_id=None, per_page=USERS_PER_PAGE):
+    """One page of the whole directory by id, after user `after_id`.
+
+    Returns (users, next_after_id or None).
+    """
+
+    query = User.query
+    if after_id is not None:
+        query = query.filter(User.id > after_id)
+
+    users = query.order_by(User.id).limit(per_page + 1).all()
+
+    if len(users) > per_page:
+        users = users[:per_page]
+        return users, users[-1].id
+
+    return users, None
+
+
+def user_added(user_id, username):
+    """Keep the in-memory indexes in step with a signup or rename."""
+
+    if fallback_index.stamp is not None:
+        fallback_index.add(user_id, username)
+
+    if autocomplete_index.loaded:
+        autocomplete_index.add(user_id, username)
+
+
+def user_removed(user_id):
+    """Keep the in-memory indexes in step with a deleted user."""
+
+    fallback_index.remove(user_id)
+    autocomplete_index.remove(user_id)
@@ -0,0 +1,331 @@
+"""Server-side sessions.
+
+The session cookie only carries a signed random session id; the session's
+contents live in a store. Besides the logged-in user's id, app.py keeps a
+compact snapshot of that user in the session (their display columns and
+followed / liked id sets), so most pages never query for the viewer.
+
+Snapshots are versioned: every user has a version number in the store,
+which the write paths bump (user_changed()) whenever something in the
+snapshot may have changed, including for other users (e.g. the followed
+side of a follow). A session's snapshot is used only while its version is
+current, so a change made by any process sharing the store is seen on the
+next request.
+
+Two stores come with it:
+
+- MemoryStore, a bounded in-process LRU (SESSION_STORE = 'memory'), for a
+  single process and for tests;
+- SocketStore (SESSION_STORE = 'unix:///path/to.sock'), a client for a
+  MemoryStore served over a local Unix socket by `flask session-store`,
+  shared by every app process on the host.
+
+Any object with the same get/set/delete/incr methods can be used instead.
+
+The stores also hold the login throttle's token buckets (take(), see
+throttle.py), so a shared store shares the login limits too.
+"""
+
+import json
+import os
+import secrets
+import socket
+import socketserver
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from itsdangerous import BadSignature, Signer, want_bytes
+
+from cache import LRUCache
+from throttle import MemoryBackend
+
+SESSION_PREFIX = 'session:'
+VERSION_PREFIX = 'user-version:'
+
+
+class MemoryStore:
+    """Keys to JSON-able values in a bounded LRU, with per-key expiry.
+
+    Numbers kept by incr() (the snapshot versions) are held apart from the
+    LRU and never evicted: a version that restarted from 0 could make an
+    old snapshot look current again.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.entries = LRUCache(maxsize=maxsize)
+        self.counters = {}
+        self.buckets = MemoryBackend(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if key in self.counters:
+            return self.counters[key]
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        value, expires = entry
+        if expires is not None and expires < time.time():
+            self.entries.pop(key)
+            return None
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.entries.set(key, (value, ttl and time.time() + ttl))
+
+    def delete(self, key):
+        self.entries.pop(key)
+        self.counters.pop(key, None)
+
+    def incr(self, key):
+        """Add one to the number under `key` (0 if unset) and return it."""
+
+        with self._lock:
+            value = self.counters[key] = self.counters.get(key, 0) + 1
+
+        return value
+
+    def take(self, key, capacity, per_seconds):
+        """Take a token from bucket `key` (see throttle.MemoryBackend)."""
+
+        return self.buckets.take(key, capacity, per_seconds)
+
+    def clear(self):
+        self.entries.clear()
+        self.counters.clear()
+        self.buckets.clear()
+
+
+class SocketStore:
+    """A store served by `flask session-store` on a local Unix socket.
+
+    Requests and replies are single lines of JSON; each thread keeps its
+    own connection open.
+    """
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            conn = self._local.conn = sock.makefile('rwb')
+
+        return conn
+
+    def _disconnect(self):
+        conn, self._local.conn = getattr(self._local, 'conn', None), None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _call(self, op, **args):
+        request = json.dumps({'op': op, **args}).encode('utf-8') + b'\n'
+
+        # one retry, on a fresh connection, if the store was restarted
+        for attempt in (1, 2):
+            try:
+                conn = self._connection()
+                conn.write(request)
+                conn.flush()
+                reply = conn.readline()
+                if reply:
+                    break
+            except OSError:
+                if attempt == 2:
+                    raise
+            self._disconnect()
+        else:
+            raise ConnectionError(f"session store at {self.path} hung up")
+
+        return json.loads(reply)['value']
+
+    def get(self, key):
+        return self._call('get', key=key)
+
+    def set(self, key, value, ttl=None):
+        self._call('set', key=key, value=value, ttl=ttl)
+
+    def delete(self, key):
+        self._call('delete', key=key)
+
+    def incr(self, key):
+        return self._call('incr', key=key)
+
+    def take(self, key, capacity, per_seconds):
+        return self._call('take', key=key, capacity=capacity,
+                          per_seconds=per_seconds)
+
+    def clear(self):
+        self._call('clear')
+
+
+class StoreRequestHandler(socketserver.StreamRequestHandler):
+    """Answers SocketStore requests from the server's MemoryStore."""
+
+    def handle(self):
+        store = self.server.store
+
+        for line in self.rfile:
+            request = json.loads(line)
+            op = request.pop('op')
+
+            if op not in ('get', 'set', 'delete', 'incr', 'take', 'clear'):
+                reply = {'value': None, 'error': f"unknown op {op!r}"}
+            else:
+                reply = {'value': getattr(store, op)(**request)}
+
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class StoreServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A MemoryStore served on a Unix socket readable by this user only."""
+
+    daemon_threads = True
+
+    def __init__(self, path, maxsize=100000):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        super().__init__(path, StoreRequestHandler)
+        os.chmod(path, 0o600)
+        self.store = MemoryStore(maxsize)
+
+
+def make_store(spec, maxsize=100000):
+    """The store named by SESSION_STORE: 'memory' or 'unix://<path>'."""
+
+    if spec == 'memory':
+        return MemoryStore(maxsize)
+
+    if spec.startswith('unix://'):
+        return SocketStore(spec[len('unix://'):])
+
+    raise ValueError(f"unknown SESSION_STORE {spec!r}")
+
+
+class ServerSideSession(SecureCookieSession):
+    """Session data kept in the store under a random id."""
+
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Move this session to a new id (e.g. on login)."""
+
+        self.replaced_sid = self.replaced_sid or self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface over a store (see module docstring)."""
+
+    serializer = TaggedJSONSerializer()
+    session_class = ServerSideSession
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='warbler-session')
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+
+        cookie = request.cookies.get(app.session_cookie_name)
+        if not cookie:
+            return self.session_class()
+
+        try:
+            sid = self._signer(app).unsign(cookie).decode('ascii')
+        except BadSignature:
+            return self.session_class()
+
+        data = self.store.get(SESSION_PREFIX + sid)
+        if data is None:
+            return self.session_class()
+
+        return self.session_class(self.serializer.loads(data), sid)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced_sid:
+            self.store.delete(SESSION_PREFIX + session.replaced_sid)
+
+        if not session:
+            if session.modified:
+                self.store.delete(SESSION_PREFIX + session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.set(SESSION_PREFIX + session.sid,
+                       self.serializer.dumps(dict(session)), ttl=lifetime)
+
+        cookie = self._signer(app).sign(want_bytes(session.sid))
+        response.set_cookie(app.session_cookie_name, cookie.decode('ascii'),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+def user_version(user_id):
+    """The current version of `user_id`'s session snapshots."""
+
+    return current_app.session_interface.store.get(
+        f"{VERSION_PREFIX}{user_id}") or 0
+
+
+def user_changed(user_id):
+    """Retire every session's snapshot of `user_id`, in every process."""
+
+    current_app.session_interface.store.incr(f"{VERSION_PREFIX}{user_id}")
+
+
+def init_app(app):
+    """Keep `app`'s sessions in the SESSION_STORE store."""
+
+    app.session_interface = ServerSideSessionInterface(
+        make_store(app.config['SESSION_STORE'],
+                   app.config['SESSION_STORE_SIZE']))
+
+    @app.cli.command('session-store')
+    @click.option('--socket', 'path', required=True,
+                  help='Unix socket path to serve the store on.')
+    def session_store(path):
+        """Serve a shared session store on a Unix socket."""
+
+        server = StoreServer(path, app.config['SESSION_STORE_SIZE'])
+        click.echo(f"Serving sessions on {path}")
+        server.serve_forever()
@@ -0,0 +1,41 @@
+"""Streamed template rendering.
+
+With STREAM_TEMPLATES set, list pages are sent as Jinja renders them, so
+the page head goes out before the list below it is loaded (see
+pagination.IdPage) and the response is never held in memory whole.
+
+Flask 1.0 has no stream_template, so this is the usual recipe: stream the
+template with the request context kept alive for the generator.
+"""
+
+from flask import (Response, current_app, render_template, session,
+                   stream_with_context)
+
+# Jinja yields after this many template chunks, so the WSGI server isn't
+# handed one tiny write per tag.
+BUFFER_SIZE = 32
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but returns a streamed Response."""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(BUFFER_SIZE)
+
+    return Response(stream_with_context(stream), mimetype='text/html')
+
+
+def render_list(template_name, **context):
+    """Render a list page, streamed if STREAM_TEMPLATES is set.
+
+    The session (and so the cookie) is saved before a streamed body is
+    produced, so pages with flash messages to show are rendered whole.
+    """
+
+    if current_app.config['STREAM_TEMPLATES'] and not session.get('_flashes'):
+        return stream_template(template_name, **context)
+
+    return render_template(template_name, **context)
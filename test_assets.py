@@ -0,0 +1,68 @@
+"""Static asset pipeline tests."""
+
+import gzip
+import os
+import shutil
+import tempfile
+
+from testing import DatabaseTestCase
+from app import app
+import assets
+
+
+class AssetsTestCase(DatabaseTestCase):
+    """Test fingerprinted, precompressed assets."""
+
+    def setUp(self):
+        self.dist_dir = tempfile.mkdtemp()
+        self.old_dist_dir = app.config['ASSETS_DIR']
+        app.config['ASSETS_DIR'] = self.dist_dir
+
+        self.manifest = assets.build(app.static_folder, self.dist_dir)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['ASSETS_DIR'] = self.old_dist_dir
+        shutil.rmtree(self.dist_dir)
+
+    def test_build(self):
+        """Testing assets get content-hashed names and gzipped copies"""
+
+        hashed = self.manifest['stylesheets/style.css']
+        self.assertRegex(hashed, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        with open(os.path.join(app.static_folder, 'stylesheets/style.css'), 'rb') as f:
+            original = f.read()
+        with open(os.path.join(self.dist_dir, hashed + '.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), original)
+
+        # images are already compressed
+        logo = self.manifest['images/warbler-logo.png']
+        self.assertFalse(os.path.exists(os.path.join(self.dist_dir, logo + '.gz')))
+
+    def test_asset_url(self):
+        """Testing templates link to fingerprinted assets"""
+
+        with app.test_request_context():
+            url = assets.asset_url('stylesheets/style.css')
+
+        self.assertEqual(
+            url, f"/static/dist/{self.manifest['stylesheets/style.css']}")
+
+    def test_send_asset(self):
+        """Testing assets are served precompressed and immutable"""
+
+        url = f"/static/dist/{self.manifest['stylesheets/style.css']}"
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        resp.close()
+
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        resp.close()
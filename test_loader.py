@@ -0,0 +1,119 @@
+"""Bulk loader tests."""
+
+import csv
+import io
+import os
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase, mock
+
+from testing import build_schema
+from models import db, Follows, Message, User
+import loader
+
+USERNAMES = [f"user{n}" for n in range(1, 7)]
+
+# two shards of users, so ids have to carry on from one file to the next
+USER_SHARDS = {'users-0000.csv': USERNAMES[:3], 'users-0001.csv': USERNAMES[3:]}
+
+# (author id, text) and (followed id, follower id), as the generator writes
+# them: by the users' positions in the users files
+MESSAGES = [(n, f"posted by user{n}") for n in (6, 1, 4, 5, 2, 6)]
+FOLLOWS = [(1, 6), (6, 1), (5, 4), (4, 5), (2, 3)]
+
+
+class Interrupted(Exception):
+    """Stands in for a crash part way through a load."""
+
+
+def write_csv(path, headers, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        writer.writerows(rows)
+
+
+class LoaderTestCase(TestCase):
+    """Test loading CSVs, without the per-test transaction (loads commit)."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        build_schema()
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+        for name, usernames in USER_SHARDS.items():
+            write_csv(os.path.join(self.data_dir, name),
+                      ['email', 'username', 'image_url', 'password', 'bio',
+                       'header_image_url', 'location'],
+                      [(f"{username}@example.com", username,
+                        "/static/images/default-pic.png", "password", "",
+                        "/static/images/warbler-hero.jpg", "")
+                       for username in usernames])
+
+        write_csv(os.path.join(self.data_dir, 'messages.csv'),
+                  ['text', 'timestamp', 'user_id'],
+                  [(text, f"2020-01-0{i + 1} 12:00:00", user_id)
+                   for i, (user_id, text) in enumerate(MESSAGES)])
+        write_csv(os.path.join(self.data_dir, 'follows.csv'),
+                  ['user_being_followed_id', 'user_following_id'], FOLLOWS)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+        # leave the empty schema the other test cases expect
+        db.session.remove()
+        loader.checkpoint_table.drop(db.engine, checkfirst=True)
+        db.drop_all()
+        db.create_all()
+
+    def load(self, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            loader.load(self.data_dir, batch_size=2, **kwargs)
+
+    def test_resume_keeps_user_ids(self):
+        """Testing an interrupted load resumes with every row on its user"""
+
+        add_rows = loader.Checkpoint.add_rows
+
+        def crash_in_second_shard(checkpoint, conn, path, count):
+            if (os.path.basename(path) == 'users-0001.csv'
+                    and checkpoint.rows_done(path)):
+                raise Interrupted
+            add_rows(checkpoint, conn, path, count)
+
+        with mock.patch.object(loader.Checkpoint, 'add_rows',
+                               crash_in_second_shard):
+            with self.assertRaises(Interrupted):
+                self.load()
+
+        # the batch that failed was rolled back with its checkpoint
+        self.assertEqual(User.query.count(), 5)
+        db.session.remove()
+
+        self.load(resume=True)
+
+        self.assertEqual(
+            sorted((user.id, user.username) for user in User.query),
+            list(enumerate(USERNAMES, 1)))
+
+        messages = Message.query.order_by(Message.timestamp).all()
+        self.assertEqual([(msg.user.username, msg.text) for msg in messages],
+                         [(f"user{user_id}", text) for user_id, text in MESSAGES])
+
+        username = dict(db.session.query(User.id, User.username))
+        self.assertEqual(
+            sorted((username[follow.user_being_followed_id],
+                    username[follow.user_following_id])
+                   for follow in Follows.query),
+            sorted((f"user{followed}", f"user{follower}")
+                   for followed, follower in FOLLOWS))
+
+        # new rows carry on after the loaded ids
+        user = User.signup(username="newuser", email="new@example.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.assertEqual(user.id, len(USERNAMES) + 1)
@@ -1,25 +1,17 @@
-import os
-from unittest import TestCase
 from models import db, User, Message, Follows
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
+from testing import DatabaseTestCase
 from app import app
+import plans
 
-db.create_all()
-
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
         u = User(
             email="test@test.com",
             username="testuser",
@@ -76,4 +68,31 @@ class MessageModelTestCase(TestCase):
             )
 
             db.session.add(m3)
-            db.session.commit()
\ No newline at end of file
+            db.session.commit()
+
+    def test_timestamps_set_on_insert(self):
+        """Testing each message is stamped by the database when added"""
+
+        started = datetime.utcnow()
+        first = Message(text="First", user_id=self.user.id)
+        db.session.add(first)
+        db.session.commit()
+
+        second = Message(text="Second", user_id=self.user.id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreaterEqual(first.timestamp, started.replace(microsecond=0))
+        self.assertGreaterEqual(second.timestamp, first.timestamp)
+        self.assertGreater(second.id, first.id)
+
+        newest = (Message.query
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .first())
+        self.assertEqual(newest.id, second.id)
+
+    def test_feed_query_plans(self):
+        """Testing the feed queries are index range scans"""
+
+        for name, (plan, full_scans) in plans.check_feed_plans(self.user.id).items():
+            self.assertEqual(full_scans, [], f"{name}: {plan}")
@@ -1,27 +1,24 @@
 """Message View tests."""
 
-import os
-from unittest import TestCase
-
-from models import db, connect_db, Message, User
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+from models import db, connect_db, Likes, Message, User, Timeline
 
+from testing import DatabaseTestCase
 from app import app, CURR_USER_KEY
-
-db.create_all()
+from fragments import fragment_cache
+from instrumentation import count_queries, query_budget
+import feeds
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        app.session_interface.store.clear()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -98,9 +95,9 @@ class MessageViewTestCase(TestCase):
             m = Message(text="Testing", user_id=self.testuser.id)
             db.session.add(m)
             db.session.commit()
-            message = Message.query.one()  
+            message_id = Message.query.one().id
 
-            resp = c.post(f"/messages/{message.id}/delete", follow_redirects=True)
+            resp = c.post(f"/messages/{message_id}/delete", follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -108,6 +105,9 @@ class MessageViewTestCase(TestCase):
             self.assertNotIn("Testing", html)
             self.assertEqual(Message.query.all(), [])
 
+            resp = c.post(f"/messages/{message_id}/delete")
+            self.assertEqual(resp.status_code, 404)
+
     def test_messages_destroy_unauthorized(self):
         """Testing unauthorized access of message delete"""
 
@@ -123,5 +123,332 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized", html)
 
+    def test_messages_destroy_liker_counts(self):
+        """Testing a liker's cached likes count drops with the liked message"""
+
+        msg = Message(text="Liked then deleted", user_id=self.testuser.id)
+        liker = User.signup(username="liker", email="liker@test.com",
+                            password="password", image_url=None)
+        db.session.add(msg)
+        db.session.commit()
+        testuser_id, liker_id, msg_id = self.testuser.id, liker.id, msg.id
+        likes_link = f'<a href="/users/{liker_id}/likes">'
+
+        liker_client = app.test_client()
+        with liker_client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = liker_id
+        liker_client.post(f"/users/add_like/{msg_id}", data={"page": "/"})
+
+        html = liker_client.get("/").get_data(as_text=True)
+        self.assertIn(f'{likes_link}1</a>', html)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post(f"/messages/{msg_id}/delete")
+
+        html = liker_client.get("/").get_data(as_text=True)
+        self.assertIn(f'{likes_link}0</a>', html)
+        self.assertEqual(User.query.get(liker_id).likes_count, 0)
+
+    def test_homepage_timeline(self):
+        """Testing home timeline follows the follow/unfollow write paths"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            user2 = User(username="testuser2",
+                         email="test2@test.com",
+                         password="testuser2")
+            db.session.add(user2)
+            db.session.commit()
+            db.session.add(Message(text="Followed warble", user_id=user2.id))
+            db.session.commit()
+            user2_id = user2.id
+
+            c.post("/messages/new", data={"text": "My own warble"})
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("My own warble", html)
+            self.assertNotIn("Followed warble", html)
+
+            c.post(f"/users/follow/{user2_id}")
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("My own warble", html)
+            self.assertIn("Followed warble", html)
+
+            c.post(f"/users/stop-following/{user2_id}")
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("My own warble", html)
+            self.assertNotIn("Followed warble", html)
+
+    def test_homepage_pulls_high_follower_authors(self):
+        """Testing messages of authors over the fan-out threshold are pulled"""
+
+        app.config['FEED_FANOUT_THRESHOLD'] = 0
+
+        try:
+            with self.client as c:
+                user2 = User.signup(username="testuser2",
+                                    email="test2@test.com",
+                                    password="testuser2",
+                                    image_url=None)
+                db.session.commit()
+                user2_id = user2.id
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                c.post(f"/users/follow/{user2_id}")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user2_id
+                c.post("/messages/new", data={"text": "Celebrity warble"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                html = c.get("/").get_data(as_text=True)
+
+                self.assertIn("Celebrity warble", html)
+                self.assertEqual(
+                    Timeline.query.filter_by(owner_id=self.testuser.id).count(), 0)
+        finally:
+            app.config['FEED_FANOUT_THRESHOLD'] = 10000
+
+    def test_homepage_author_pushed_again(self):
+        """Testing an author who drops back under the threshold is pushed"""
+
+        author, fan2, fan3 = [User(username=f"user{i}",
+                                   email=f"user{i}@test.com",
+                                   password="HASHED_PASSWORD")
+                              for i in range(3)]
+        db.session.add_all([author, fan2, fan3])
+        db.session.commit()
+        author_id, fan_ids = author.id, [self.testuser.id, fan2.id, fan3.id]
+
+        def log_in(c, user_id):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+        app.config['FEED_FANOUT_THRESHOLD'] = 2
+
+        try:
+            with self.client as c:
+                for fan_id in fan_ids:
+                    log_in(c, fan_id)
+                    c.post(f"/users/follow/{author_id}")
+                self.assertTrue(feeds.is_pulled(author_id))
+
+                log_in(c, author_id)
+                c.post("/messages/new", data={"text": "Pulled warble"})
+
+                # 2 followers is still within the margin below the threshold
+                log_in(c, fan3.id)
+                c.post(f"/users/stop-following/{author_id}")
+                self.assertTrue(feeds.is_pulled(author_id))
+
+                log_in(c, fan2.id)
+                c.post(f"/users/stop-following/{author_id}")
+                self.assertFalse(feeds.is_pulled(author_id))
+
+                self.assertEqual(
+                    Timeline.query.filter_by(owner_id=self.testuser.id).count(), 1)
+
+                log_in(c, self.testuser.id)
+                app.config['FEED_FANOUT_THRESHOLD'] = 10000
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("Pulled warble", html)
+        finally:
+            app.config['FEED_FANOUT_THRESHOLD'] = 10000
+
+    def test_homepage_query_budget(self):
+        """Testing the home page stays within its query budget"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for i in range(5):
+                c.post("/messages/new", data={"text": f"Warble {i}"})
+
+            with query_budget(8):
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("X-Query-Count", resp.headers)
+
+    def test_homepage_author_loading(self):
+        """Testing feed authors load in constant queries for every strategy"""
+
+        authors = [User(username=f"author{i}",
+                        email=f"author{i}@test.com",
+                        password="HASHED_PASSWORD")
+                   for i in range(10)]
+        db.session.add_all(authors)
+        db.session.commit()
+        author_ids = [author.id for author in authors]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for author_id in author_ids:
+                c.post(f"/users/follow/{author_id}")
+
+            db.session.add_all([Message(text=f"By author{i}", user_id=author_id)
+                                for i, author_id in enumerate(author_ids)])
+            db.session.commit()
+            feeds.rebuild_timelines()
+            db.session.commit()
+
+            # with the current user cached: the feed, the pulled-author
+            # check and, for selectin, one IN() query for all ten authors
+            expected = {'selectin': 3, 'joined': 2, 'lean': 2}
+
+            try:
+                for strategy in feeds.AUTHOR_LOADING_STRATEGIES:
+                    app.config['FEED_AUTHOR_LOADING'] = strategy
+                    c.get("/")
+
+                    with count_queries() as stats:
+                        resp = c.get("/")
+                    html = resp.get_data(as_text=True)
+
+                    self.assertEqual(stats.count, expected[strategy])
+                    self.assertIn("@author9", html)
+                    self.assertIn("By author0", html)
+            finally:
+                app.config['FEED_AUTHOR_LOADING'] = 'selectin'
+
+    def test_message_item_cached_per_viewer(self):
+        """Testing message items are cached but like buttons are per viewer"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        msg = Message(text="Cached warble", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        testuser_id, other_id, msg_id = self.testuser.id, other.id, msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+
+            c.post(f"/users/add_like/{msg_id}", data={"page": "/"})
+            resp = c.get(f"/users/{testuser_id}")
+            self.assertIn("btn-primary", resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            hits = fragment_cache.hits
+            resp = c.get(f"/users/{testuser_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(fragment_cache.hits, hits + 1)
+            self.assertIn("Cached warble", html)
+            self.assertNotIn("btn-primary", html)
+
+    def test_homepage_not_modified(self):
+        """Testing the home page answers a current ETag with a 304"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "First warble"})
+
+            resp = c.get("/")
+            etag = resp.headers["ETag"]
+
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            c.post("/messages/new", data={"text": "Second warble"})
+
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Second warble", resp.get_data(as_text=True))
+
+    def test_messages_show_not_modified(self):
+        """Testing a message page answers a current ETag with a 304"""
+
+        message = Message(text="Tagged warble", user_id=self.testuser.id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            etag = c.get(f"/messages/{message_id}").headers["ETag"]
+
+            resp = c.get(f"/messages/{message_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f"/users/add_like/{message_id}",
+                   data={"page": f"/messages/{message_id}", "liked": "1"})
+
+            resp = c.get(f"/messages/{message_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+            self.assertEqual(c.get("/messages/0").status_code, 404)
+
+    def test_like_double_submit(self):
+        """Testing a repeated like submit leaves the message liked once"""
+
+        msg = Message(text="Liked twice", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        testuser_id, msg_id = self.testuser.id, msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            for _ in range(2):
+                resp = c.post(f"/users/add_like/{msg_id}",
+                              data={"page": "/", "liked": "1"})
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(Likes.query.filter_by(user_id=testuser_id).count(), 1)
+            self.assertEqual(User.query.get(testuser_id).likes_count, 1)
+
+            resp = c.post("/users/add_like/999999", data={"page": "/"})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_like_totals(self):
+        """Testing several users can like a message and its total shows"""
+
+        msg = Message(text="Popular warble", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        testuser_id, msg_id = self.testuser.id, msg.id
+
+        liker_ids = []
+        for i in range(2):
+            liker = User.signup(username=f"liker{i}", email=f"liker{i}@test.com",
+                                password="password", image_url=None)
+            db.session.commit()
+            liker_ids.append(liker.id)
+
+        with self.client as c:
+            for liker_id in liker_ids:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = liker_id
+                c.post(f"/users/add_like/{msg_id}", data={"page": "/"})
+
+            self.assertEqual(Message.query.get(msg_id).likes_count, 2)
+
+            with count_queries() as stats:
+                resp = c.get(f"/users/{testuser_id}")
+            html = resp.get_data(as_text=True)
 
-                    
\ No newline at end of file
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 2', html)
+            self.assertFalse([sql for sql in stats.statements
+                              if 'count(' in sql.lower()])
@@ -0,0 +1,105 @@
+"""Server-side session tests."""
+
+import os
+import shutil
+import tempfile
+import threading
+
+from models import db, User
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from instrumentation import count_queries
+import sessions
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SessionTestCase(DatabaseTestCase):
+    """Test the session store and the logged-in user's snapshot."""
+
+    def setUp(self):
+        app.session_interface.store.clear()
+
+        self.client = app.test_client()
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+    def test_cookie_holds_only_session_id(self):
+        """Testing session data stays on the server"""
+
+        with self.client as c:
+            resp = c.post("/login", data={"username": "testuser",
+                                          "password": "testuser"})
+            cookie = resp.headers["Set-Cookie"].split(";")[0].split("=", 1)[1]
+            sid = cookie.rsplit(".", 1)[0]
+
+            data = app.session_interface.store.get(sessions.SESSION_PREFIX + sid)
+            self.assertIn(CURR_USER_KEY, data)
+            self.assertNotIn("curr_user", cookie)
+
+    def test_user_snapshot_reused_until_changed(self):
+        """Testing the viewer is loaded once, and again after a change"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with count_queries() as first:
+                c.get("/")
+            with count_queries() as cached:
+                c.get("/")
+
+            self.assertLess(cached.count, first.count)
+
+            with app.app_context():
+                sessions.user_changed(self.testuser_id)
+
+            with count_queries() as changed:
+                c.get("/")
+
+            self.assertEqual(changed.count, first.count)
+
+    def test_versions_outlive_eviction(self):
+        """Testing snapshot versions are not evicted with session data"""
+
+        store = sessions.MemoryStore(maxsize=2)
+        store.incr("user-version:1")
+
+        for i in range(5):
+            store.set(f"session:{i}", {}, ttl=60)
+
+        self.assertEqual(store.get("user-version:1"), 1)
+        self.assertEqual(store.incr("user-version:1"), 2)
+
+    def test_socket_store(self):
+        """Testing the shared store over a Unix socket"""
+
+        socket_dir = tempfile.mkdtemp()
+        path = os.path.join(socket_dir, "sessions.sock")
+        server = sessions.StoreServer(path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            store = sessions.SocketStore(path)
+            store.set("key", "value", ttl=60)
+            self.assertEqual(store.get("key"), "value")
+            self.assertEqual(store.incr("version"), 1)
+            self.assertEqual(store.incr("version"), 2)
+
+            store.delete("key")
+            self.assertIsNone(store.get("key"))
+            self.assertEqual(server.store.get("version"), 2)
+
+            # the login throttle's buckets, shared through the store
+            self.assertEqual(store.take("login:address:x", 2, 60), 0)
+            self.assertEqual(store.take("login:address:x", 2, 60), 0)
+            self.assertGreater(store.take("login:address:x", 2, 60), 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(socket_dir)
@@ -1,26 +1,18 @@
 """User model tests."""
 
-import os
-from unittest import TestCase
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
+from hashing import HashingBusy, PasswordHasher, hash_cost, hasher
 from sqlalchemy.exc import IntegrityError
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
+from testing import DatabaseTestCase
 from app import app
 
-db.create_all()
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
         self.client = app.test_client()
 
     def tearDown(self):
@@ -139,6 +131,78 @@ class UserModelTestCase(TestCase):
         db.session.commit()
         self.assertFalse(user2.is_following(user1))
 
+    def test_recount(self):
+        """Testing User recount repairs denormalized counters"""
+
+        user1 = User(
+            email="test@test.com",
+            username="testuser",
+            password="HASHED_PASSWORD"
+        )
+
+        user2 = User(
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD"
+        )
+
+        db.session.add_all([user1, user2])
+        db.session.commit()
+
+        user1.followers.append(user2)
+        message = Message(text="Counted", user_id=user1.id)
+        user2.likes.append(message)
+        db.session.add(message)
+        db.session.commit()
+
+        self.assertEqual(user1.followers_count, 0)
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(user1.followers_count, 1)
+        self.assertEqual(user1.messages_count, 1)
+        self.assertEqual(user2.following_count, 1)
+        self.assertEqual(user2.likes_count, 1)
+
+    def test_follow_and_like_writes_idempotent(self):
+        """Testing repeated follow/like writes change rows and counters once"""
+
+        user1 = User(email="test@test.com", username="testuser",
+                     password="HASHED_PASSWORD")
+        user2 = User(email="test2@test.com", username="testuser2",
+                     password="HASHED_PASSWORD")
+        db.session.add_all([user1, user2])
+        db.session.commit()
+
+        message = Message(text="Liked", user_id=user1.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.assertTrue(Follows.add(user2.id, user1.id))
+        self.assertFalse(Follows.add(user2.id, user1.id))
+        self.assertTrue(Likes.add(user2.id, message.id))
+        self.assertFalse(Likes.add(user2.id, message.id))
+        db.session.commit()
+
+        self.assertTrue(user1.is_followed_by(user2))
+        self.assertEqual(user1.followers_count, 1)
+        self.assertEqual(user2.following_count, 1)
+        self.assertEqual(user2.likes_count, 1)
+        self.assertEqual(message.likes_count, 1)
+
+        self.assertTrue(Follows.remove(user2.id, user1.id))
+        self.assertFalse(Follows.remove(user2.id, user1.id))
+        self.assertTrue(Likes.remove(user2.id, message.id))
+        self.assertFalse(Likes.remove(user2.id, message.id))
+        db.session.commit()
+
+        self.assertFalse(user1.is_followed_by(user2))
+        self.assertEqual(user1.followers_count, 0)
+        self.assertEqual(user2.following_count, 0)
+        self.assertEqual(user2.likes_count, 0)
+        self.assertEqual(message.likes_count, 0)
+
     def test_signup(self):
         """Testing User signup method"""
 
@@ -180,4 +244,34 @@ class UserModelTestCase(TestCase):
         self.assertNotIsInstance(user2, User)
 
         user3 = User.authenticate("testuser", "sdfdsafdsg")
-        self.assertFalse(user3)    
\ No newline at end of file
+        self.assertFalse(user3)    
+
+    def test_authenticate_rehashes_outdated_cost(self):
+        """A password hashed at an old cost is rehashed at the new one on login"""
+
+        rounds = hasher.log_rounds
+        try:
+            hasher.log_rounds = 4
+            User.signup(username="testuser", email="test@test.com",
+                        password="testpassword", image_url="http://test.jpg")
+            db.session.commit()
+
+            hasher.log_rounds = 5
+            user = User.authenticate("testuser", "testpassword")
+            self.assertEqual(hash_cost(user.password), 5)
+            self.assertTrue(user.check_password("testpassword"))
+        finally:
+            hasher.log_rounds = rounds
+
+    def test_hashing_backpressure(self):
+        """Hashing is refused once too many jobs are pending"""
+
+        busy_hasher = PasswordHasher(log_rounds=4, max_pending=1,
+                                     queue_timeout=0.01)
+        busy_hasher._slots.acquire()
+
+        with self.assertRaises(HashingBusy):
+            busy_hasher.hash("testpassword")
+
+        busy_hasher._slots.release()
+        self.assertEqual(hash_cost(busy_hasher.hash("testpassword")), 4)
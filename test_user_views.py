@@ -1,31 +1,33 @@
 """User View tests."""
 
-import os
-from unittest import TestCase
+import gzip
 
-from models import db, connect_db, Message, User
+from flask import session
+from sqlalchemy.exc import DBAPIError
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-
-# Now we can import app
+from models import db, connect_db, Follows, Likes, Message, User
 
+from testing import DatabaseTestCase
 from app import app, CURR_USER_KEY
-# app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler_test'
-
-db.create_all()
+from fragments import fragment_cache
+from instrumentation import count_queries, metrics, query_budget
+import search
+from search import autocomplete_index, build_autocomplete_index
+import throttle
+from throttle import login_throttle
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class UserViewTestCase(TestCase):
+class UserViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        app.session_interface.store.clear()
+        fragment_cache.clear()
+        login_throttle.backend.clear()
 
         self.client = app.test_client()
 
@@ -46,6 +48,103 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("testuser", html)
 
+    def test_list_users_follow_buttons(self):
+        """Testing user cards show follow state of the logged in user"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            user2 = User(username="testuser2",
+                         email="test2@test.com",
+                         password="testuser2",
+                        )
+            user3 = User(username="testuser3",
+                         email="test3@test.com",
+                         password="testuser3",
+                        )
+            db.session.add_all([user2, user3])
+            db.session.commit()
+            user2_id, user3_id = user2.id, user3.id
+
+            c.post(f"/users/follow/{user2_id}")
+            html = c.get("/users").get_data(as_text=True)
+
+            self.assertIn(f'action="/users/stop-following/{user2_id}"', html)
+            self.assertIn(f'action="/users/follow/{user3_id}"', html)
+
+    def test_list_users_search(self):
+        """Testing username search ranks prefix matches first"""
+
+        with self.client as c:
+            db.session.add_all([
+                User(username=name, email=f"{name}@test.com", password="HASHED")
+                for name in ["xalphax", "alpha", "beta"]])
+            db.session.commit()
+
+            html = c.get("/users?q=alph").get_data(as_text=True)
+
+            self.assertIn("@alpha", html)
+            self.assertIn("@xalphax", html)
+            self.assertNotIn("@beta", html)
+            self.assertLess(html.index("@alpha<"), html.index("@xalphax"))
+
+            html = c.get("/users?q=%25").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_list_users_paginated(self):
+        """Testing the user directory is paged"""
+
+        with self.client as c:
+            db.session.add_all([
+                User(username=f"user{i}", email=f"user{i}@test.com", password="HASHED")
+                for i in range(30)])
+            db.session.commit()
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertEqual(html.count('class="card-bio"'), 24)
+
+            next_url = html.split('href="/users?after=')[1].split('"')[0]
+            html = c.get(f"/users?after={next_url}").get_data(as_text=True)
+            self.assertEqual(html.count('class="card-bio"'), 7)
+            self.assertNotIn("More users", html)
+
+    def test_autocomplete_users(self):
+        """Testing autocomplete follows signups without touching the DB"""
+
+        with self.client as c:
+            testuser_id = self.testuser.id
+            build_autocomplete_index()
+
+            c.post("/signup", data={"username": "testautocomplete",
+                                    "email": "auto@test.com",
+                                    "password": "password"})
+
+            with count_queries() as stats:
+                resp = c.get("/api/users/autocomplete?q=TESTA")
+
+            self.assertEqual(stats.count, 0)
+            self.assertEqual([user["username"] for user in resp.json["users"]],
+                             ["testautocomplete"])
+
+            resp = c.get("/api/users/autocomplete?q=testuser")
+            self.assertEqual(resp.json["users"],
+                             [{"id": testuser_id, "username": "testuser"}])
+
+    def test_autocomplete_index_built_at_startup(self):
+        """Testing the autocomplete index is ready before any request"""
+
+        testuser_id = self.testuser.id
+        autocomplete_index.load([])
+        app.config['AUTOCOMPLETE_AT_STARTUP'] = True
+        try:
+            search.init_app(app)
+        finally:
+            app.config['AUTOCOMPLETE_AT_STARTUP'] = False
+
+        self.assertEqual(autocomplete_index.complete("testuser", 10),
+                         [(testuser_id, "testuser")])
+
     def test_users_show(self):
         """Testing if user profile page displays"""
 
@@ -56,6 +155,80 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@testuser", html)
 
+    def test_users_show_paginated(self):
+        """Testing profile messages are paged with an older-warbles cursor"""
+
+        with self.client as c:
+            db.session.add_all([Message(text=f"Warble <{i}>", user_id=self.testuser.id)
+                                for i in range(25)])
+            db.session.commit()
+
+            resp = c.get(f"/users/{self.testuser.id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count("Warble &lt;"), 20)
+            self.assertIn("Warble &lt;24&gt;", html)
+            self.assertNotIn("Warble &lt;4&gt;", html)
+
+            cursor = html.split('href="?before=')[1].split('"')[0]
+            resp = c.get(f"/users/{self.testuser.id}?before={cursor}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count("Warble &lt;"), 5)
+            self.assertIn("Warble &lt;4&gt;", html)
+            self.assertIn("Warble &lt;0&gt;", html)
+            self.assertNotIn("?before=", html)
+
+    def test_users_likes_paginated(self):
+        """Testing liked messages are paged with an older-warbles cursor"""
+
+        messages = [Message(text=f"Liked <{i}>", user_id=self.testuser.id)
+                    for i in range(25)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.testuser.likes.extend(messages)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/users/{self.testuser.id}/likes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count("Liked &lt;"), 20)
+            self.assertIn("Liked &lt;24&gt;", html)
+            self.assertNotIn("Liked &lt;4&gt;", html)
+
+            cursor = html.split('href="?before=')[1].split('"')[0]
+            resp = c.get(f"/users/{self.testuser.id}/likes?before={cursor}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count("Liked &lt;"), 5)
+            self.assertIn("Liked &lt;0&gt;", html)
+            self.assertNotIn("?before=", html)
+
+    def test_users_show_query_budget(self):
+        """Testing the profile page stays within its query budget"""
+
+        with self.client as c:
+            db.session.add_all([Message(text=f"Warble {i}", user_id=self.testuser.id)
+                                for i in range(25)])
+            db.session.commit()
+
+            with query_budget(6):
+                resp = c.get(f"/users/{self.testuser.id}")
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_users_show_bad_cursor(self):
+        """Testing a malformed cursor is rejected"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser.id}?before=not-a-cursor")
+
+            self.assertEqual(resp.status_code, 400)
+
     def test_show_following(self):
         """Testing if current user can view who user follows"""
 
@@ -359,6 +532,33 @@ class UserViewTestCase(TestCase):
             self.assertIn('<h4 id="sidebar-username">@testuser</h4>', html)
             self.assertIn("@testuser2", html)  
 
+    def test_follow_counters(self):
+        """Testing follow and unfollow keep both users' counters in step"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            user2 = User(username="testuser2",
+                         email="test2@test.com",
+                         password="testuser2",
+                        )
+            db.session.add(user2)
+            db.session.commit()
+            user2_id = user2.id
+
+            c.post(f"/users/follow/{user2_id}")
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 1)
+            self.assertEqual(User.query.get(user2_id).followers_count, 1)
+
+            resp = c.get(f"/users/{user2_id}")
+            self.assertIn(f'/users/{user2_id}/followers">1</a>',
+                          resp.get_data(as_text=True))
+
+            c.post(f"/users/stop-following/{user2_id}")
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 0)
+            self.assertEqual(User.query.get(user2_id).followers_count, 0)
+
     def test_add_follow_unauthorized(self):
         """Testing if logged out user is prohibited from following"""
 
@@ -405,6 +605,25 @@ class UserViewTestCase(TestCase):
             self.assertIn('<h4 id="sidebar-username">@testuser</h4>', html)
             self.assertNotIn("@testuser2", html)
 
+    def test_current_user_cached(self):
+        """Testing the logged in user is served from cache until changed"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            first = int(c.get("/").headers["X-Query-Count"])
+            second = int(c.get("/").headers["X-Query-Count"])
+            self.assertLess(second, first)
+
+            data = {"username": "renameduser",
+                    "email": "test@test.com",
+                    "password": "testuser"}
+            c.post("/users/profile", data=data)
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("@renameduser", html)
+
     def test_show_profile(self):
         """Testing display of edit profile page"""
 
@@ -468,6 +687,51 @@ class UserViewTestCase(TestCase):
             self.assertIn('Join Warbler today', html)
             self.assertIn('Sign me up!', html)
 
+    def test_delete_user_with_messages(self):
+        """Testing deleting a user who posted, followed and liked recounts the rest"""
+
+        user2 = User.signup(username="testuser2", email="test2@test.com",
+                            password="testuser2", image_url=None)
+        user3 = User.signup(username="testuser3", email="test3@test.com",
+                            password="testuser3", image_url=None)
+        db.session.commit()
+        testuser_id, user2_id, user3_id = self.testuser.id, user2.id, user3.id
+
+        own = [Message(text=f"Mine {i}", user_id=testuser_id) for i in range(2)]
+        theirs = Message(text="Theirs", user_id=user2_id)
+        db.session.add_all([*own, theirs])
+        db.session.commit()
+        User.recount()
+
+        Follows.add(testuser_id, user2_id)
+        Follows.add(user3_id, testuser_id)
+        Likes.add(testuser_id, theirs.id)
+        Likes.add(user2_id, own[0].id)
+        Likes.add(user3_id, own[1].id)
+        db.session.commit()
+        theirs_id = theirs.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post("/users/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(User.query.get(testuser_id))
+            self.assertEqual(Message.query.filter_by(user_id=testuser_id).count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(Likes.query.count(), 0)
+
+            user2, user3 = User.query.get(user2_id), User.query.get(user3_id)
+            self.assertEqual((user2.followers_count, user2.following_count,
+                              user2.likes_count, user2.messages_count),
+                             (0, 0, 0, 1))
+            self.assertEqual((user3.followers_count, user3.following_count,
+                              user3.likes_count, user3.messages_count),
+                             (0, 0, 0, 0))
+            self.assertEqual(Message.query.get(theirs_id).likes_count, 0)
+
     def test_delete_user_unauthorized(self):
         """Testing prohibition of logged out user to delete"""
 
@@ -477,4 +741,200 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
         
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Access unauthorized", html)
\ No newline at end of file
+            self.assertIn("Access unauthorized", html)
+
+    def test_user_card_refreshed_on_profile_edit(self):
+        """Testing a cached user card shows the edited profile"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get("/users")
+
+            data = {"username": "renamedtestuser",
+                    "email": "test@test.com",
+                    "bio": "Check out my story",
+                    "password": "testuser"}
+            c.post("/users/profile", data=data)
+
+            resp = c.get("/users")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@renamedtestuser", html)
+            self.assertIn("Check out my story", html)
+
+    def test_users_show_not_modified(self):
+        """Testing profiles answer a current ETag with a 304"""
+
+        user2 = User.signup(username="testuser2",
+                            email="test2@test.com",
+                            password="testuser2",
+                            image_url=None)
+        db.session.commit()
+        testuser_id, user2_id = self.testuser.id, user2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{user2_id}")
+            etag = resp.headers["ETag"]
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+            resp = c.get(f"/users/{user2_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # following changes the page's counters and button
+            c.post(f"/users/follow/{user2_id}")
+
+            resp = c.get(f"/users/{user2_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_static_files_cached(self):
+        """Testing versioned static files are cached as immutable"""
+
+        with app.test_request_context():
+            url = app.jinja_env.globals['static_url']('stylesheets/style.css')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        resp.close()
+
+    def test_list_users_compressed(self):
+        """Testing pages are gzipped for clients that accept it"""
+
+        resp = self.client.get("/users", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertIn("@testuser", gzip.decompress(resp.get_data()).decode())
+
+        resp = self.client.get("/users")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn("@testuser", resp.get_data(as_text=True))
+
+    def test_compressed_pages_cached(self):
+        """Testing compressed copies of tagged pages are reused"""
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            headers = {"Accept-Encoding": "gzip"}
+            first = c.get(f"/users/{testuser_id}", headers=headers)
+            hits = metrics.counters['compression.cache_hits']
+            second = c.get(f"/users/{testuser_id}", headers=headers)
+
+            self.assertTrue(first.headers["ETag"].startswith("W/"))
+            self.assertEqual(metrics.counters['compression.cache_hits'], hits + 1)
+            self.assertEqual(first.get_data(), second.get_data())
+
+    def test_users_followers_paginated(self):
+        """Testing followers are listed a page at a time by id"""
+
+        followers = [User(username=f"follower{i}",
+                          email=f"follower{i}@test.com",
+                          password="HASHED_PASSWORD")
+                     for i in range(30)]
+        db.session.add_all(followers)
+        db.session.commit()
+        for follower in followers:
+            follower.following.append(self.testuser)
+        db.session.commit()
+        testuser_id = self.testuser.id
+        follower_ids = sorted(follower.id for follower in followers)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            html = c.get(f"/users/{testuser_id}/followers").get_data(as_text=True)
+
+            self.assertEqual(html.count('class="card user-card"'), 24)
+            self.assertIn(f"after={follower_ids[23]}", html)
+
+            html = c.get(f"/users/{testuser_id}/followers?after={follower_ids[23]}"
+                         ).get_data(as_text=True)
+
+            self.assertEqual(html.count('class="card user-card"'), 6)
+            self.assertNotIn("More users", html)
+
+    def test_users_likes_streamed(self):
+        """Testing list pages can be streamed"""
+
+        msg = Message(text="Streamed warble", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.testuser.likes.append(msg)
+        db.session.commit()
+        testuser_id = self.testuser.id
+
+        app.config['STREAM_TEMPLATES'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser_id
+
+                resp = c.get(f"/users/{testuser_id}/likes")
+
+                self.assertTrue(resp.is_streamed)
+                self.assertIn("Streamed warble", resp.get_data(as_text=True))
+        finally:
+            app.config['STREAM_TEMPLATES'] = False
+
+    def test_login_throttled(self):
+        """Testing repeated logins are refused before any password check"""
+
+        with self.client as c:
+            for _ in range(5):
+                resp = c.post("/login", data={"username": "TestUser",
+                                              "password": "wrongpassword"})
+                self.assertEqual(resp.status_code, 200)
+
+            with count_queries() as stats:
+                resp = c.post("/login", data={"username": "testuser",
+                                              "password": "testuser"})
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Retry-After", resp.headers)
+            self.assertIn("Too many login attempts", resp.get_data(as_text=True))
+            self.assertEqual(stats.count, 0)
+            self.assertNotIn(CURR_USER_KEY, session)
+            self.assertGreater(metrics.counters["throttle.login.shed.username"], 0)
+
+    def test_login_throttled_per_forwarded_address(self):
+        """Testing clients behind a trusted proxy get their own buckets"""
+
+        wsgi_app = app.wsgi_app
+        app.wsgi_app = throttle.trust_proxies(wsgi_app, 1)
+        login_throttle.limits[1] = ('address', (1, 60))
+
+        def attempt(username, address):
+            return self.client.post("/login",
+                                    data={"username": username,
+                                          "password": "wrongpassword"},
+                                    headers={"X-Forwarded-For": address},
+                                    environ_base={"REMOTE_ADDR": "10.0.0.1"})
+
+        try:
+            self.assertEqual(attempt("first", "203.0.113.1").status_code, 200)
+            self.assertEqual(attempt("second", "203.0.113.2").status_code, 200)
+            self.assertEqual(attempt("third", "203.0.113.1").status_code, 429)
+        finally:
+            app.wsgi_app = wsgi_app
+            throttle.init_app(app)
+
+    def test_failed_query_not_left_timing(self):
+        """Testing a failed statement doesn't skew later query timings"""
+
+        connection = db.session.connection()
+
+        with self.assertRaises(DBAPIError):
+            connection.execute("SELECT * FROM no_such_table")
+
+        self.assertEqual(connection.info.get('query_started'), [])
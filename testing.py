@@ -0,0 +1,177 @@
+"""Database fixtures for the test suites.
+
+Import this before `app` in a test module: it points DATABASE_URL at the
+test database, which is
+
+- PostgreSQL `warbler_test` (or TEST_DATABASE_URL) by default;
+- with pytest-xdist (`python -m pytest -n 4`), a database per worker,
+  warbler_test_gw0, warbler_test_gw1, ..., created on first use;
+- with TEST_DATABASE=sqlite, an in-memory SQLite database (foreign keys
+  enforced), which needs no server but skips the PostgreSQL-only parts of
+  the schema (e.g. the trigram index).
+
+The schema is built once per test process. DatabaseTestCase then runs each
+test class inside a transaction on one connection and each test inside a
+savepoint within it, rolled back when the test ends, so tests see a clean
+database without deleting anything. Data a whole class needs can be made
+once in its seed() classmethod.
+
+Sessions used during a test (including the ones Flask-SQLAlchemy opens per
+request) are bound to that connection and begin their own savepoint, so
+the code under test can commit and roll back as usual.
+"""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session
+
+DEFAULT_DATABASE_URL = 'postgresql:///warbler_test'
+
+
+def database_url():
+    """The database this test process runs against."""
+
+    if os.environ.get('TEST_DATABASE') == 'sqlite':
+        return 'sqlite://'
+
+    url = os.environ.get('TEST_DATABASE_URL', DEFAULT_DATABASE_URL)
+
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker:
+        url = f"{url}_{worker}"
+
+    return url
+
+
+os.environ['DATABASE_URL'] = database_url()
+
+# the cheapest bcrypt cost, hashed in-thread: tests sign up a user each
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+os.environ.setdefault('HASH_WORKERS', '0')
+
+# the schema is only built after import (tests build the index themselves)
+os.environ.setdefault('AUTOCOMPLETE_AT_STARTUP', '0')
+
+import app  # noqa: E402,F401 (binds db to the app)
+from models import db  # noqa: E402
+
+_schema_built = False
+
+
+def create_database(url):
+    """Create the PostgreSQL database `url` names, if it doesn't exist."""
+
+    url = make_url(url)
+    if url.get_backend_name() != 'postgresql':
+        return
+
+    server_url = make_url(str(url))
+    server_url.database = 'postgres'
+    engine = create_engine(server_url, isolation_level='AUTOCOMMIT')
+
+    try:
+        with engine.connect() as conn:
+            exists = conn.scalar("SELECT 1 FROM pg_database WHERE datname = %s",
+                                 (url.database,))
+            if not exists:
+                conn.execute(f'CREATE DATABASE "{url.database}"')
+    finally:
+        engine.dispose()
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # let SQLAlchemy, not pysqlite, begin transactions (or savepoints break)
+    dbapi_connection.isolation_level = None
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def _sqlite_begin(conn):
+    conn.execute("BEGIN")
+
+
+def build_schema():
+    """Create the test database and its tables, once per process."""
+
+    global _schema_built
+    if _schema_built:
+        return
+
+    engine = db.engine
+
+    if engine.dialect.name == 'sqlite':
+        # the in-memory database lives as long as its one connection
+        engine.dispose()
+        event.listen(engine, 'connect', _sqlite_connect)
+        event.listen(engine, 'begin', _sqlite_begin)
+    else:
+        create_database(engine.url)
+
+    db.drop_all()
+    db.create_all()
+
+    _schema_built = True
+
+
+def _restart_savepoint(session, transaction):
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+def _bound_session(connection):
+    """A session on `connection` that keeps a savepoint open."""
+
+    session = db.create_session({'bind': connection, 'binds': {}})()
+    session.begin_nested()
+    event.listen(session, 'after_transaction_end', _restart_savepoint)
+
+    return session
+
+
+class DatabaseTestCase(TestCase):
+    """A TestCase whose database changes are rolled back after each test."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        build_schema()
+
+        cls._connection = db.engine.connect()
+        cls._transaction = cls._connection.begin()
+
+        cls._app_session = db.session
+        db.session = scoped_session(lambda: _bound_session(cls._connection))
+
+        cls.seed()
+        db.session.commit()
+        db.session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.session = cls._app_session
+
+        cls._transaction.rollback()
+        cls._connection.close()
+
+        super().tearDownClass()
+
+    @classmethod
+    def seed(cls):
+        """Add rows every test in this class uses (kept until the class ends)."""
+
+    def run(self, result=None):
+        savepoint = self._connection.begin_nested()
+
+        try:
+            return super().run(result)
+        finally:
+            db.session.remove()
+            if savepoint.is_active:
+                savepoint.rollback()
@@ -0,0 +1,153 @@
+"""Admission control for login attempts.
+
+Every login POST costs a bcrypt check (see hashing.py), which is exactly
+what a credential-stuffing burst exploits. Before User.authenticate() runs,
+login_attempt() charges the attempt to two token buckets, one for the
+username tried and one for the client's address, and refuses it (429) once
+either is empty. Buckets hold LOGIN_LIMIT_PER_USERNAME /
+LOGIN_LIMIT_PER_ADDRESS = (attempts, seconds) tokens and refill at that
+rate, so short bursts are allowed but a sustained stream is not.
+
+Admitted attempts must also get one of LOGIN_MAX_CONCURRENT slots for the
+password check itself; when all are taken the attempt is shed at once
+(503) instead of queueing, which keeps the rest of the app responsive.
+
+Bucket state lives in a backend: by default the session store (see
+sessions.py), whose take() keeps the buckets in a MemoryBackend. With
+SESSION_STORE = 'unix://...' that store is shared by every app process on
+the host, and so are the limits; with 'memory' each process has its own,
+so N processes allow N times the limits. THROTTLE_BACKEND can be set to
+any other object with the same take() method.
+
+The address is the client's as the app sees it. Behind reverse proxies,
+set TRUSTED_PROXIES to how many there are, so it is taken from their
+X-Forwarded-For header rather than being the nearest proxy's (for which
+every client would share one bucket).
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    PROXY_COUNT_ARG = 'x_for'
+except ImportError:  # Werkzeug < 0.15
+    from werkzeug.contrib.fixers import ProxyFix
+    PROXY_COUNT_ARG = 'num_proxies'
+
+from cache import LRUCache
+from instrumentation import metrics
+
+
+class Throttled(Exception):
+    """A login attempt refused before its password was checked."""
+
+    def __init__(self, reason, status, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class MemoryBackend:
+    """Token buckets in a bounded in-process LRU cache."""
+
+    def __init__(self, maxsize=100000):
+        self.buckets = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, per_seconds, now=None):
+        """Take a token from bucket `key`.
+
+        The bucket holds up to `capacity` tokens and refills at `capacity`
+        per `per_seconds`. Returns 0 if a token was taken, else the seconds
+        until the next one is due.
+        """
+
+        now = time.monotonic() if now is None else now
+        rate = capacity / per_seconds
+
+        with self._lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            if tokens < 1:
+                self.buckets.set(key, (tokens, now))
+                return (1 - tokens) / rate
+
+            self.buckets.set(key, (tokens - 1, now))
+            return 0
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class LoginThrottle:
+    """Per-username and per-address limits plus a concurrency cap."""
+
+    def __init__(self, backend=None, per_username=(5, 60),
+                 per_address=(20, 60), max_concurrent=4):
+        self.configure(backend, per_username, per_address, max_concurrent)
+
+    def configure(self, backend, per_username, per_address, max_concurrent):
+        self.backend = backend or MemoryBackend()
+        self.limits = [('username', per_username), ('address', per_address)]
+        self.max_concurrent = max_concurrent
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def _charge(self, username, address):
+        keys = {'username': username.strip().lower(), 'address': address}
+
+        for kind, (capacity, per_seconds) in self.limits:
+            wait = self.backend.take(f"login:{kind}:{keys[kind]}",
+                                     capacity, per_seconds)
+            if wait:
+                metrics.incr(f"throttle.login.shed.{kind}")
+                raise Throttled(kind, 429, wait)
+
+    @contextmanager
+    def attempt(self, username, address):
+        """Admit a login attempt, or raise Throttled.
+
+        The password check is run inside the `with` block, which holds one
+        of the concurrency slots.
+        """
+
+        self._charge(username, address)
+
+        if not self._slots.acquire(blocking=False):
+            metrics.incr('throttle.login.shed.concurrency')
+            raise Throttled('concurrency', 503, 1)
+
+        metrics.incr('throttle.login.admitted')
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+login_throttle = LoginThrottle()
+
+
+def trust_proxies(wsgi_app, count):
+    """Wrap `wsgi_app` to take the client address from X-Forwarded-For,
+    as set by `count` reverse proxies in front of it."""
+
+    return ProxyFix(wsgi_app, **{PROXY_COUNT_ARG: count})
+
+
+def init_app(app):
+    """Configure the login throttle from `app`'s config.
+
+    Call after sessions.init_app: the buckets default to its store.
+    """
+
+    login_throttle.configure(app.config['THROTTLE_BACKEND']
+                             or app.session_interface.store,
+                             app.config['LOGIN_LIMIT_PER_USERNAME'],
+                             app.config['LOGIN_LIMIT_PER_ADDRESS'],
+                             app.config['LOGIN_MAX_CONCURRENT'])
+
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = trust_proxies(app.wsgi_app, app.config['TRUSTED_PROXIES'])